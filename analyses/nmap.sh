@@ -37,7 +37,12 @@ if ! [ -f ${WORK_DIR}/run.sh ]; then
     exit 1
 fi
 
-TARGET_IP=`grep "GUESTIP=" "${WORK_DIR}"/run.sh | cut -d= -f2`
+# address from the network configuration stored by makeNetwork.py, or from
+# run.sh if there is none
+TARGET_IP=`"${SCRIPT_DIR}/firmadb.py" get-ip "${IID}" 2> /dev/null || true`
+if [ -z "${TARGET_IP}" ]; then
+    TARGET_IP=`grep "^GUESTIP=" "${WORK_DIR}"/run.sh | cut -d= -f2`
+fi
 
 if [ -z "${TARGET_IP}" ]; then
     echo "[-] Found no target IP address ..."
@@ -46,7 +51,17 @@ fi
 
 echo "[+] Found IP: ${TARGET_IP}"
 
-sudo nmap ${NMAP_OPTS} "${TARGET_IP}" -oA "$WORK_DIR"nmap-basic-tcp | tee "${WORK_DIR}"nmap-basic-tcp.txt 2>&1
+# instances started with FIRMADYNE_NETNS set are only reachable from inside
+# their network namespace
+NETNS=`get_netns ${IID}`
+if ip netns list 2> /dev/null | grep -qw "^${NETNS}"; then
+    echo "[+] Using network namespace ${NETNS}"
+    NS="sudo ip netns exec ${NETNS}"
+else
+    NS="sudo"
+fi
+
+${NS} nmap ${NMAP_OPTS} "${TARGET_IP}" -oA "$WORK_DIR"nmap-basic-tcp | tee "${WORK_DIR}"nmap-basic-tcp.txt 2>&1
 
 echo -e "\nDumped Nmap scan details of ${TARGET_IP} to $WORK_DIR"
 
@@ -1,37 +1,275 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
+import os
+import sys
+import time
 import traceback
-import urllib.request
-import http.client
-import socket
+import urllib.parse
 
-import psycopg2
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "scripts"))
+import firmadb
+import webroot
+
+# bytes of each response body searched for scripted redirects; the rest of a
+# body is only read to reuse the connection, up to DRAIN_LIMIT bytes
+BODY_LIMIT = 64 * 1024
+DRAIN_LIMIT = 1024 * 1024
+
+MAX_HEADERS = 100
+MAX_REDIRECTS = 5
+
+REDIRECT_MARKERS = [b"location.href", b"window.location"]
+
+class ProbeError(Exception):
+    # the target did not answer a request, as opposed to answering with an
+    # error status
+    pass
+
+class Connection(object):
+    # a keep-alive HTTP/1.1 connection to the target, reopened as needed
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def readHead(self):
+        line = await self.reader.readline()
+        if not line:
+            raise EOFError("connection closed")
+        parts = line.decode("latin-1").split(None, 2)
+        if len(parts) < 2 or not parts[0].startswith("HTTP/") or not parts[1].isdigit():
+            raise ProbeError("bad status line: %r" % line[:80])
+        headers = dict()
+        for i in range(MAX_HEADERS):
+            line = await self.reader.readline()
+            if not line:
+                raise EOFError("connection closed")
+            if line in [b"\r\n", b"\n"]:
+                return (parts[0], int(parts[1]), headers)
+            k, sep, v = line.decode("latin-1").partition(":")
+            headers[k.strip().lower()] = v.strip()
+        raise ProbeError("too many headers")
+
+    async def readUpTo(self, limit):
+        # read() only returns what is already buffered, so a body that
+        # arrives in several segments is collected until the limit or EOF
+        data = b""
+        while len(data) < limit:
+            chunk = await self.reader.read(limit - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    async def readBody(self, status, headers, method="GET"):
+        # returns the start of the body, and whether it was read completely
+        if method == "HEAD" or 100 <= status < 200 or status in [204, 304]:
+            # never have a body, whatever the headers say
+            return (b"", True)
+        data = b""
+        total = 0
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size = int((await self.reader.readline()).split(b";")[0].strip() or b"0", 16)
+                if size == 0:
+                    while (await self.reader.readline()) not in [b"\r\n", b"\n", b""]:
+                        pass
+                    return (data, True)
+                if total + size > DRAIN_LIMIT:
+                    return (data, False)
+                chunk = await self.reader.readexactly(size + 2)
+                data += chunk[:size][:BODY_LIMIT - len(data)]
+                total += size
+        if "content-length" in headers:
+            length = int(headers["content-length"])
+            if length > DRAIN_LIMIT:
+                return (await self.readUpTo(BODY_LIMIT), False)
+            chunk = await self.reader.readexactly(length)
+            return (chunk[:BODY_LIMIT], True)
+        # delimited by the end of the connection
+        return (await self.readUpTo(BODY_LIMIT), False)
+
+    async def get(self, path):
+        # returns (status, headers, start of body)
+        for attempt in range(2):
+            fresh = self.writer is None
+            if fresh:
+                (self.reader, self.writer) = await asyncio.open_connection(self.host, self.port)
+            try:
+                self.writer.write(("GET %s HTTP/1.1\r\nHost: %s\r\nConnection: keep-alive\r\n"
+                                   "Accept: */*\r\nUser-Agent: firmadyne\r\n\r\n" % \
+                                   (path, self.host)).encode("latin-1"))
+                await self.writer.drain()
+                (version, status, headers) = await self.readHead()
+                while 100 <= status < 200 and status != 101:
+                    # interim responses precede the final one
+                    (version, status, headers) = await self.readHead()
+            except (EOFError, ConnectionError):
+                # the server closed a connection that was kept alive
+                self.close()
+                if fresh:
+                    raise ProbeError("connection closed")
+                continue
+            (data, complete) = await self.readBody(status, headers)
+            keepAlive = headers.get("connection", "").lower() != "close" and \
+                (version != "HTTP/1.0" or headers.get("connection", "").lower() == "keep-alive")
+            if not complete or not keepAlive:
+                self.close()
+            return (status, headers, data)
+        raise ProbeError("connection closed")
+
+class Prober(object):
+    # requests a list of paths from the target on a limited number of
+    # connections, with a time limit per request and overall, and gives up on
+    # the remaining paths once the target stops answering
+    def __init__(self, target, concurrency=8, timeout=5, budget=None, maxFailures=5):
+        parts = urllib.parse.urlsplit("//" + target)
+        self.target = target
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.budget = budget
+        self.maxFailures = maxFailures
+        self.failures = 0
+        self.aborted = None
+        self.deadline = None
+
+    def url(self, path):
+        return urllib.parse.urlunsplit(("http", self.target, path, None, None))
+
+    async def fetch(self, conn, path):
+        # follows redirects on the same host, like urlopen; returns (status,
+        # start of body, location of a redirect to another host)
+        for i in range(MAX_REDIRECTS + 1):
+            (status, headers, data) = await conn.get(path)
+            if status not in [301, 302, 303, 307, 308] or "location" not in headers:
+                return (status, data, None)
+            location = urllib.parse.urlsplit(urllib.parse.urljoin(self.url(path), headers["location"]))
+            if location.netloc and location.netloc != self.target:
+                return (status, data, location.geturl())
+            path = urllib.parse.urlunsplit(("", "", location.path or "/", location.query, ""))
+        return (status, data, None)
+
+    async def probe(self, conn, path):
+        # returns (accessible, redirect, message)
+        remaining = self.deadline - time.time() if self.deadline else self.timeout
+        if remaining <= 0:
+            return (False, False, "-> Socket Timeout: time budget exceeded")
+        try:
+            (status, data, offsite) = await asyncio.wait_for(self.fetch(conn, path),
+                                                             min(self.timeout, remaining))
+        except asyncio.TimeoutError:
+            conn.close()
+            self.failures += 1
+            return (False, False, "-> Socket Timeout: timed out")
+        except (ProbeError, OSError, ValueError, asyncio.IncompleteReadError) as e:
+            conn.close()
+            self.failures += 1
+            return (False, False, "-> URLError: %s" % e)
+        self.failures = 0
+        if status >= 400:
+            return (False, False, "-> HTTPError: %d" % status)
+        if offsite:
+            # served by another host, if at all
+            return (False, False, "-> Redirect to other host: %s" % offsite)
+        if any([x in data for x in REDIRECT_MARKERS]):
+            return (True, True, "-> Redirect")
+        return (True, False, None)
+
+    async def worker(self, queue, results):
+        conn = Connection(self.host, self.port)
+        try:
+            while not queue.empty():
+                (i, tail) = queue.get_nowait()
+                if self.failures >= self.maxFailures:
+                    self.aborted = "target stopped answering after %d failed requests" % self.failures
+                if self.deadline and time.time() >= self.deadline:
+                    self.aborted = "time budget of %d s exceeded" % self.budget
+                if self.aborted:
+                    return
+                url = self.url(urllib.parse.quote(tail, safe="/~&=;:@+,$!*'()"))
+                results[i] = await self.probe(conn, urllib.parse.urlsplit(url).path or "/")
+                message = results[i][2]
+                print("Accessing: %s...%s" % (url, "\n" + message if message else ""))
+        finally:
+            conn.close()
+
+    async def run(self, tails):
+        self.deadline = time.time() + self.budget if self.budget else None
+        queue = asyncio.Queue()
+        for x in enumerate(tails):
+            queue.put_nowait(x)
+        results = [None] * len(tails)
+        await asyncio.gather(*[self.worker(queue, results) for i in range(self.concurrency)])
+        return results
+
+def probe(target, tails, concurrency=8, timeout=5, budget=None, maxFailures=5):
+    # returns the accessible paths, marking those that redirect in scripts,
+    # and the reason for stopping early, if any
+    prober = Prober(target, concurrency, timeout, budget, maxFailures)
+    results = asyncio.run(prober.run(tails))
+    accessible = []
+    for (tail, result) in zip(tails, results):
+        if result and result[0]:
+            accessible.append(tail + " (REDIR)" if result[1] else tail)
+    return (accessible, prober.aborted)
 
 def main():
     parser = argparse.ArgumentParser(
         description="Test accesses of files over HTTP versus filesystem")
     parser.add_argument("id", action="store", type=int, help="Input image id")
     parser.add_argument("ip", action="store",
-                        help="IP address of emulated image")
+                        help="IP address of emulated image, or - for the stored network configuration")
     parser.add_argument("log", action="store",
                         help="Output list of accessible URLs")
-    parser.add_argument("sql", action="store", default="127.0.0.1", nargs="?",
-                        help="Hostname of SQL server")
-    parser.add_argument("-p", action="store", dest="pattern", default="/www/",
-                        help="Filename pattern of files to access")
+    parser.add_argument("sql", action="store", default=None, nargs="?",
+                        help="Hostname of SQL server (default: from firmadyne.config)")
+    parser.add_argument("-p", action="store", dest="pattern", default=None,
+                        help="Filename pattern of files to access (default: the files classified by webroot.py, or /www/)")
+    parser.add_argument("-c", action="store", dest="concurrency", type=int, default=8,
+                        help="Number of concurrent requests")
+    parser.add_argument("-t", action="store", dest="timeout", type=float, default=5,
+                        help="Timeout of each request in seconds")
+    parser.add_argument("-T", action="store", dest="budget", type=float, default=None,
+                        help="Time limit for all requests in seconds")
+    parser.add_argument("-f", action="store", dest="failures", type=int, default=5,
+                        help="Give up after this many requests in a row are not answered")
     cmd = parser.parse_args()
 
-    db = psycopg2.connect(database="firmware", user="firmadyne",
-                          password="firmadyne", host=cmd.sql)
+    db = firmadb.connect(cmd.sql)
+
+    if cmd.ip == "-":
+        cur = db.cursor()
+        cmd.ip = firmadb.getIP(cur, cmd.id)
+        cur.close()
+        if not cmd.ip:
+            db.close()
+            print("Error: No network configuration stored for image %d" % cmd.id)
+            sys.exit(1)
 
     files = []
+    tails = []
+    pattern = cmd.pattern or "/www/"
     try:
         cur = db.cursor()
-        cur.execute(
-            "SELECT filename FROM object_to_image WHERE iid=%s AND filename LIKE %s",
-            (cmd.id, '%' + cmd.pattern + '%'))
-        files = cur.fetchall()
+        if not cmd.pattern:
+            # files below the document roots, classified at ingest
+            tails = [x.lstrip("/") for x in webroot.getFiles(cur, cmd.id)]
+        if not tails:
+            cur.execute(
+                "SELECT filename FROM object_to_image WHERE iid=%s AND filename LIKE %s",
+                (cmd.id, '%' + pattern + '%'))
+            files = cur.fetchall()
     except BaseException:
         traceback.print_exc()
     finally:
@@ -40,34 +278,20 @@ def main():
         if db:
             db.close()
 
-    accessible = []
     for file in files:
-        head, sep, tail = file[0].partition(cmd.pattern)
+        head, sep, tail = file[0].partition(pattern)
         if tail and ('.' not in tail or any(tail.endswith(ext) \
             for ext in [".htm", ".html", ".cgi", ".asp", ".php",
                         ".bin", ".xml", ".rg"])):
-            try:
-                url = urllib.parse.urlunsplit(
-                    ("http", cmd.ip, tail, None, None))
-                print("Accessing: %s..." % url)
-                req = urllib.request.urlopen(url, timeout=5)
-                data = req.read()
-                if b"location.href" in data or b"window.location" in data:
-                    print("-> Redirect")
-                    accessible.append(tail + " (REDIR)")
-                else:
-                    accessible.append(tail)
-            except socket.timeout as exc:
-                print("-> Socket Timeout: %s" % exc)
-            except http.client.IncompleteRead as exc:
-                data = exc.partial
-            except urllib.error.HTTPError as exc:
-                print("-> HTTPError: %d" % exc.code)
-            except urllib.error.URLError as exc:
-                print("-> URLError: %s" % exc.reason)
+            tails.append(tail)
         elif tail:
             print("Skipping: %s..." % tail)
 
+    (accessible, aborted) = probe(cmd.ip, tails, cmd.concurrency, cmd.timeout,
+                                  cmd.budget, cmd.failures)
+    if aborted:
+        print("Stopped early: %s" % aborted)
+
     with open(cmd.log, "w") as file:
         for url in accessible:
             file.write(url + "\n")
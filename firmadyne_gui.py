@@ -8,6 +8,7 @@ from tkinter import ttk, filedialog, messagebox, simpledialog
 from pathlib import Path
 import threading
 import queue
+import socket
 
 try:
     from tkinterdnd2 import TkinterDnD, DND_FILES
@@ -518,9 +519,53 @@ export PGPASSWORD='{self.db_password}'
             )
             self.firmware_path = None
 
+    def _wait_for_guest(self, ip_address, timeout, ports=(80, 443, 23)):
+        """Wait until a service of the guest accepts connections, or the emulation exits"""
+        # The network comes up well before the services of a cold boot, so
+        # answering pings is not enough; a guest without any of these
+        # services is given the whole timeout, as before
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.emulation_process.poll() is not None:
+                return False
+            for port in ports:
+                try:
+                    socket.create_connection((ip_address, port), 1).close()
+                    return True
+                except OSError:
+                    pass
+            time.sleep(1)
+        return self.emulation_process.poll() is None
+
+    def _get_guest_ip(self, image_name, run_script_path):
+        """Return the address of the guest stored by makeNetwork.py"""
+        try:
+            result = subprocess.run(
+                [os.path.join(self.firmadyne_path, "scripts/firmadb.py"), "get-ip", str(image_name)],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                text=True,
+                cwd=self.firmadyne_path
+            )
+            if result.returncode == 0 and result.stdout.strip():
+                return result.stdout.strip()
+        except OSError:
+            pass
+        # Fall back to the address in the start script
+        try:
+            with open(run_script_path) as f:
+                for line in f:
+                    if line.startswith("GUESTIP="):
+                        ip_address = line.strip().split("=", 1)[1]
+                        if ip_address:
+                            return ip_address
+        except OSError:
+            pass
+        return "192.168.0.100"
+
     def _run_analyses(self, image_name, run_script_path):
         """Run all analysis processes"""
-        ip_address = "192.168.0.100"  # Make this configurable if needed
+        ip_address = self._get_guest_ip(image_name, run_script_path)
         log_file = os.path.join(self.firmadyne_path, f"scratch/{image_name}/analyses.log")
 
         def display_snmp_files():
@@ -575,12 +620,15 @@ export PGPASSWORD='{self.db_password}'
             if hasattr(self, 'terminal_text') and self.terminal_text:
                 self.terminal_text.insert(tk.END, "[Starting emulation...]\n")
             
+            # Resume from a snapshot of the booted firmware if there is one
+            run_env = dict(os.environ, FIRMADYNE_SNAPSHOT="1")
             self.emulation_process = subprocess.Popen(
                 [run_script_path],
                 stdout=subprocess.PIPE,
                 stderr=subprocess.STDOUT,
                 stdin=subprocess.PIPE,
-                text=True
+                text=True,
+                env=run_env
             )
             
             if hasattr(self, 'emulation_output') and self.emulation_output:
@@ -594,11 +642,9 @@ export PGPASSWORD='{self.db_password}'
             if hasattr(self, 'terminal_text') and self.terminal_text:
                 self.terminal_text.insert(tk.END, "[Waiting for emulation to stabilize...]\n")
             
-            # Wait longer for emulation to fully stabilize
-            time.sleep(60)  # Increased to 60 seconds
-            
-            # Check if emulation is still running
-            if self.emulation_process.poll() is not None:
+            # Wait until the guest serves requests, which is almost
+            # immediate when the emulation was restored from a snapshot
+            if not self._wait_for_guest(ip_address, 60):
                 raise Exception("Emulation process terminated unexpectedly")
             
             if hasattr(self, 'terminal_text') and self.terminal_text:
@@ -0,0 +1,667 @@
+#!/usr/bin/env python3
+
+import getopt
+import os
+import posixpath
+import stat
+import struct
+import sys
+import tarfile
+import time
+
+# raw disk image layout, matching the fdisk defaults used by makeImage.sh: an
+# MBR followed by a single Linux partition starting at 1 MiB
+SECTOR_SIZE = 512
+PARTITION_START = 2048
+
+# ext2 revision 1 parameters; inode numbers below FIRST_INO are reserved
+BLOCK_SIZE = 4096
+BLOCKS_PER_GROUP = BLOCK_SIZE * 8
+INODE_SIZE = 128
+INODE_RATIO = 4096
+RESERVED_PERCENT = 5
+ROOT_INO = 2
+FIRST_INO = 11
+POINTERS = BLOCK_SIZE // 4
+
+# number of blocks read from the tarball at a time
+CHUNK_BLOCKS = 64
+
+FEATURE_INCOMPAT_FILETYPE = 0x2
+FEATURE_RO_COMPAT_LARGE_FILE = 0x2
+
+# directory entry file types
+FILE_TYPES = {
+    stat.S_IFREG : 1,
+    stat.S_IFDIR : 2,
+    stat.S_IFCHR : 3,
+    stat.S_IFBLK : 4,
+    stat.S_IFIFO : 5,
+    stat.S_IFSOCK : 6,
+    stat.S_IFLNK : 7,
+}
+
+# default device nodes created by fixImage.sh, as (path, mode, type, major,
+# minor)
+DEVICES = [
+    ("/dev/mem", 0o660, stat.S_IFCHR, 1, 1),
+    ("/dev/kmem", 0o640, stat.S_IFCHR, 1, 2),
+    ("/dev/null", 0o666, stat.S_IFCHR, 1, 3),
+    ("/dev/zero", 0o666, stat.S_IFCHR, 1, 5),
+    ("/dev/random", 0o444, stat.S_IFCHR, 1, 8),
+    ("/dev/urandom", 0o444, stat.S_IFCHR, 1, 9),
+    ("/dev/armem", 0o666, stat.S_IFCHR, 1, 13),
+    ("/dev/tty", 0o666, stat.S_IFCHR, 5, 0),
+    ("/dev/console", 0o622, stat.S_IFCHR, 5, 1),
+    ("/dev/ptmx", 0o666, stat.S_IFCHR, 5, 2),
+    ("/dev/tty0", 0o622, stat.S_IFCHR, 4, 0),
+    ("/dev/ttyS0", 0o660, stat.S_IFCHR, 4, 64),
+    ("/dev/ttyS1", 0o660, stat.S_IFCHR, 4, 65),
+    ("/dev/ttyS2", 0o660, stat.S_IFCHR, 4, 66),
+    ("/dev/ttyS3", 0o660, stat.S_IFCHR, 4, 67),
+    ("/dev/adsl0", 0o644, stat.S_IFCHR, 100, 0),
+    ("/dev/ppp", 0o644, stat.S_IFCHR, 108, 0),
+    ("/dev/hidraw0", 0o666, stat.S_IFCHR, 251, 0),
+] + [("/dev/mtd/%d" % i, 0o644, stat.S_IFCHR, 90, 2 * i) for i in range(11)] + \
+    [x for i in range(11) for x in [("/dev/mtd%d" % i, 0o644, stat.S_IFCHR, 90, 2 * i),
+                                    ("/dev/mtdr%d" % i, 0o644, stat.S_IFCHR, 90, 2 * i + 1)]] + \
+    [("/dev/mtdblock/%d" % i, 0o644, stat.S_IFBLK, 31, i) for i in range(11)] + \
+    [("/dev/mtdblock%d" % i, 0o644, stat.S_IFBLK, 31, i) for i in range(11)] + \
+    [("/dev/tts/%d" % i, 0o660, stat.S_IFCHR, 4, 64 + i) for i in range(4)]
+
+# default NVRAM entries created by fixImage.sh when a binary references them,
+# as (binary, key, value)
+NVRAM_DEFAULTS = [
+    ("/sbin/rc", "ipv6_6to4_lan_ip", b"2002:7f00:0001::"),
+    ("/lib/libacos_shared.so", "time_zone_x", b"0"),
+    ("/usr/sbin/httpd", "rip_multicast", b"0"),
+    ("/usr/sbin/httpd", "bs_trustedip_enable", b"0"),
+    ("/usr/sbin/httpd", "filter_rule_tbl", b""),
+    ("/sbin/acos_service", "rip_enable", b"0"),
+]
+
+ROOT_USER = b"root::0:0:root:/root:/bin/sh\n"
+
+def splitPath(path):
+    return [x for x in posixpath.normpath("/" + path).split("/") if x]
+
+def encodeName(name):
+    # tarfile decodes names with surrogateescape, so this is lossless
+    return name.encode("utf-8", "surrogateescape")
+
+class Node(object):
+    # in-memory inode; hard links share the same Node
+    def __init__(self, kind, mode=0o755, uid=0, gid=0, mtime=None):
+        self.kind = kind
+        self.mode = mode
+        self.uid = uid
+        self.gid = gid
+        self.mtime = int(time.time() if mtime is None else mtime)
+        self.size = 0
+        self.blocks = []
+        self.target = None
+        self.rdev = (0, 0)
+        self.children = dict() if kind == stat.S_IFDIR else None
+        self.ino = None
+        self.links = 0
+
+class Ext2Image(object):
+    # writes a partitioned raw ext2 image without mounting it: file contents
+    # are written to their final location while the tarball is read, and
+    # the metadata is kept in memory until finish()
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.offset = PARTITION_START * SECTOR_SIZE
+        self.root = Node(stat.S_IFDIR)
+        self.layout((size - self.offset) // BLOCK_SIZE)
+        self.cursor = (0, self.dataStart(0))
+        self.f = open(path, "w+b")
+        self.f.truncate(size)
+
+    def layout(self, total):
+        for i in range(2):
+            self.groups = (total + BLOCKS_PER_GROUP - 1) // BLOCKS_PER_GROUP
+            self.gdtBlocks = (self.groups * 32 + BLOCK_SIZE - 1) // BLOCK_SIZE
+            # whole inode table blocks, and no more than one bitmap block
+            perBlock = BLOCK_SIZE // INODE_SIZE
+            ipg = (total * BLOCK_SIZE // INODE_RATIO + self.groups - 1) // self.groups
+            self.inodesPerGroup = min(BLOCK_SIZE * 8,
+                                      (ipg + perBlock - 1) // perBlock * perBlock)
+            self.tableBlocks = self.inodesPerGroup // perBlock
+            self.overhead = 3 + self.gdtBlocks + self.tableBlocks
+            # like mke2fs, drop a last group that is too small to be useful
+            last = total - (self.groups - 1) * BLOCKS_PER_GROUP
+            if self.groups == 1 or last >= self.overhead + 50:
+                break
+            total = (self.groups - 1) * BLOCKS_PER_GROUP
+        if total < self.overhead + 50:
+            raise ValueError("Image size %d is too small" % self.size)
+        self.blocks = total
+        self.inodes = self.inodesPerGroup * self.groups
+
+    def groupStart(self, g):
+        return g * BLOCKS_PER_GROUP
+
+    def groupEnd(self, g):
+        return min((g + 1) * BLOCKS_PER_GROUP, self.blocks)
+
+    def blockBitmap(self, g):
+        return self.groupStart(g) + 1 + self.gdtBlocks
+
+    def inodeTable(self, g):
+        return self.blockBitmap(g) + 2
+
+    def dataStart(self, g):
+        return self.inodeTable(g) + self.tableBlocks
+
+    def allocate(self, count):
+        # blocks are handed out in order and never reused, so unwritten parts
+        # of the image are still zero
+        result = []
+        (g, b) = self.cursor
+        while len(result) < count:
+            if b >= self.groupEnd(g):
+                g += 1
+                if g >= self.groups:
+                    raise ValueError("Image size %d is too small" % self.size)
+                b = self.dataStart(g)
+            n = min(count - len(result), self.groupEnd(g) - b)
+            result.extend(range(b, b + n))
+            b += n
+        self.cursor = (g, b)
+        return result
+
+    def writeBlocks(self, blocks, data):
+        # one write per run of consecutive blocks
+        i = 0
+        while i < len(blocks):
+            j = i + 1
+            while j < len(blocks) and blocks[j] == blocks[j - 1] + 1:
+                j += 1
+            self.f.seek(self.offset + blocks[i] * BLOCK_SIZE)
+            self.f.write(data[i * BLOCK_SIZE:j * BLOCK_SIZE])
+            i = j
+
+    def readData(self, node):
+        data = []
+        i = 0
+        while i < len(node.blocks):
+            j = i + 1
+            while j < len(node.blocks) and node.blocks[j] == node.blocks[j - 1] + 1:
+                j += 1
+            self.f.seek(self.offset + node.blocks[i] * BLOCK_SIZE)
+            data.append(self.f.read((j - i) * BLOCK_SIZE))
+            i = j
+        return b"".join(data)[:node.size]
+
+    def setData(self, node, data):
+        # the old blocks, if any, are left unreferenced and end up free
+        node.blocks = self.allocate((len(data) + BLOCK_SIZE - 1) // BLOCK_SIZE)
+        node.size = len(data)
+        self.writeBlocks(node.blocks, data)
+
+    def writeStream(self, node, fp):
+        node.blocks = []
+        node.size = 0
+        while True:
+            data = fp.read(CHUNK_BLOCKS * BLOCK_SIZE)
+            if not data:
+                break
+            blocks = self.allocate((len(data) + BLOCK_SIZE - 1) // BLOCK_SIZE)
+            self.writeBlocks(blocks, data)
+            node.blocks.extend(blocks)
+            node.size += len(data)
+
+    def resolve(self, path, follow=True, create=False, depth=0):
+        # walks the tree like the kernel would inside a chroot, following
+        # symbolic links, and returns (directory, name, node); with create,
+        # missing intermediate directories are created
+        parts = splitPath(path)
+        d = self.root
+        if not parts:
+            return (None, None, d)
+        for i in range(len(parts)):
+            name = parts[i]
+            node = d.children.get(name)
+            last = i == len(parts) - 1
+            if node is not None and node.kind == stat.S_IFLNK and \
+                    (follow or not last):
+                if depth >= 40:
+                    return (None, None, None)
+                return self.resolve(posixpath.join("/", *(parts[:i] + [node.target] + parts[i + 1:])),
+                                    follow, create, depth + 1)
+            if last:
+                return (d, name, node)
+            if node is None:
+                if not create:
+                    return (None, None, None)
+                node = Node(stat.S_IFDIR)
+                d.children[name] = node
+            elif node.kind != stat.S_IFDIR:
+                return (None, None, None)
+            d = node
+
+    def add(self, path, node):
+        (d, name, old) = self.resolve(path, follow=False, create=True)
+        if old is not None and old.kind == stat.S_IFDIR and node.kind == stat.S_IFDIR:
+            # keep the contents, but apply the metadata from the tarball
+            (old.mode, old.uid, old.gid, old.mtime) = \
+                (node.mode, node.uid, node.gid, node.mtime)
+        elif d is None:
+            sys.stderr.write("Warning: Skipping %s\n" % path)
+        else:
+            d.children[name] = node
+
+    def addMember(self, t, member):
+        args = (member.mode & 0o7777, member.uid, member.gid, member.mtime)
+        if member.isdir():
+            node = Node(stat.S_IFDIR, *args)
+        elif member.isfile():
+            node = Node(stat.S_IFREG, *args)
+            self.writeStream(node, t.extractfile(member))
+        elif member.issym():
+            node = Node(stat.S_IFLNK, 0o777, *args[1:])
+            node.target = member.linkname
+        elif member.islnk():
+            node = self.resolve(member.linkname, follow=False)[2]
+            if node is None or node.kind == stat.S_IFDIR:
+                sys.stderr.write("Warning: Skipping hard link %s\n" % member.name)
+                return
+        elif member.ischr() or member.isblk():
+            node = Node(stat.S_IFCHR if member.ischr() else stat.S_IFBLK, *args)
+            node.rdev = (member.devmajor, member.devminor)
+        elif member.isfifo():
+            node = Node(stat.S_IFIFO, *args)
+        else:
+            return
+        self.add(member.name, node)
+
+    def addTarball(self, infile):
+        with tarfile.open(infile, "r|*") as t:
+            for member in t:
+                t.members = []
+                self.addMember(t, member)
+
+    def addFile(self, path, source, mode=0o755):
+        node = Node(stat.S_IFREG, mode)
+        with open(source, "rb") as f:
+            self.writeStream(node, f)
+        self.add(path, node)
+
+    def numberInodes(self):
+        # root and lost+found get their usual numbers, everything else is
+        # numbered depth-first
+        lost = self.root.children.get("lost+found")
+        if lost is None or lost.kind != stat.S_IFDIR:
+            lost = self.root.children["lost+found"] = Node(stat.S_IFDIR, 0o700)
+        self.root.ino = ROOT_INO
+        lost.ino = FIRST_INO
+        nodes = [self.root, lost]
+        directories = [(self.root, self.root)]
+        count = FIRST_INO + 1
+        i = 0
+        while i < len(directories):
+            (d, parent) = directories[i]
+            i += 1
+            d.links = 2
+            for name in sorted(d.children):
+                node = d.children[name]
+                if node.kind == stat.S_IFDIR:
+                    d.links += 1
+                    directories.append((node, d))
+                else:
+                    node.links += 1
+                if node.ino is None:
+                    node.ino = count
+                    count += 1
+                    nodes.append(node)
+        if count - 1 > self.inodes:
+            raise ValueError("Image has %d inodes, but %d are needed" % \
+                             (self.inodes, count - 1))
+        return (nodes, directories)
+
+    def directoryData(self, d, parent):
+        entries = [(d.ino, b".", stat.S_IFDIR), (parent.ino, b"..", stat.S_IFDIR)] + \
+            [(d.children[x].ino, encodeName(x), d.children[x].kind) for x in sorted(d.children)]
+        blocks = []
+        cur = bytearray()
+        last = 0
+        for (ino, name, kind) in entries:
+            length = (8 + len(name) + 3) & ~3
+            if len(cur) + length > BLOCK_SIZE:
+                # the last entry in a block covers the rest of the block
+                struct.pack_into("<H", cur, last + 4, BLOCK_SIZE - last)
+                blocks.append(bytes(cur.ljust(BLOCK_SIZE, b"\0")))
+                cur = bytearray()
+            last = len(cur)
+            cur += struct.pack("<IHBB", ino, length, len(name), FILE_TYPES[kind])
+            cur += name.ljust(length - 8, b"\0")
+        struct.pack_into("<H", cur, last + 4, BLOCK_SIZE - last)
+        blocks.append(bytes(cur.ljust(BLOCK_SIZE, b"\0")))
+        return b"".join(blocks)
+
+    def indirect(self, blocks, level, meta):
+        # writes the tree of (single, double or triple) indirect blocks
+        if level > 1:
+            span = POINTERS ** (level - 1)
+            blocks = [self.indirect(blocks[i:i + span], level - 1, meta) \
+                      for i in range(0, len(blocks), span)]
+        block = self.allocate(1)[0]
+        meta.append(block)
+        self.writeBlocks([block], struct.pack("<%dI" % len(blocks), *blocks))
+        return block
+
+    def mapBlocks(self, node):
+        meta = []
+        pointers = node.blocks[:12]
+        rest = node.blocks[12:]
+        for level in range(1, 4):
+            if not rest:
+                break
+            span = POINTERS ** level
+            pointers.append(self.indirect(rest[:span], level, meta))
+            rest = rest[span:]
+        if rest:
+            raise ValueError("File is too large")
+        return (pointers + [0] * (15 - len(pointers)), meta)
+
+    def packInode(self, node):
+        meta = []
+        if node.kind == stat.S_IFLNK and len(encodeName(node.target)) < 60:
+            # fast symbolic link, stored in place of the block pointers
+            blocks = encodeName(node.target).ljust(60, b"\0")
+            size = len(encodeName(node.target))
+        elif node.kind in (stat.S_IFCHR, stat.S_IFBLK):
+            (major, minor) = node.rdev
+            pointers = [0] * 15
+            if major < 256 and minor < 256:
+                pointers[0] = (major << 8) | minor
+            else:
+                pointers[1] = (minor & 0xff) | (major << 8) | ((minor & ~0xff) << 12)
+            blocks = struct.pack("<15I", *pointers)
+            size = 0
+        else:
+            (pointers, meta) = self.mapBlocks(node)
+            blocks = struct.pack("<15I", *pointers)
+            size = node.size
+        count = (len(node.blocks) + len(meta)) * (BLOCK_SIZE // 512)
+        data = struct.pack("<2H5I2H3I60s4I2B3HI", node.kind | node.mode,
+                           node.uid & 0xffff, size & 0xffffffff, node.mtime,
+                           node.mtime, node.mtime, 0, node.gid & 0xffff,
+                           node.links, count, 0, 0, blocks, 0, 0, size >> 32,
+                           0, 0, 0, 0, node.uid >> 16, node.gid >> 16, 0)
+        return (data, meta)
+
+    def finish(self):
+        (nodes, directories) = self.numberInodes()
+
+        # contents of directories and long symbolic links
+        for (d, parent) in directories:
+            self.setData(d, self.directoryData(d, parent))
+        for node in nodes:
+            if node.kind == stat.S_IFLNK and len(encodeName(node.target)) >= 60:
+                self.setData(node, encodeName(node.target))
+
+        # inode tables, written one group at a time
+        used = bytearray((self.blocks + 7) // 8)
+        freeInodes = [self.inodesPerGroup] * self.groups
+        dirs = [0] * self.groups
+        tables = [bytearray() for g in range(self.groups)]
+        large = False
+        for node in sorted(nodes, key=lambda x: x.ino):
+            (data, meta) = self.packInode(node)
+            g = (node.ino - 1) // self.inodesPerGroup
+            index = (node.ino - 1) % self.inodesPerGroup
+            tables[g] += b"\0" * (index * INODE_SIZE - len(tables[g])) + data
+            if node.kind == stat.S_IFDIR:
+                dirs[g] += 1
+            large = large or node.size >= (1 << 31)
+            for b in node.blocks + meta:
+                used[b >> 3] |= 1 << (b & 7)
+        for g in range(self.groups):
+            self.f.seek(self.offset + self.inodeTable(g) * BLOCK_SIZE)
+            self.f.write(tables[g])
+        inodes = max([x.ino for x in nodes])
+
+        # bitmaps and group descriptors
+        descriptors = bytearray()
+        freeBlocks = 0
+        for g in range(self.groups):
+            start = self.groupStart(g)
+            count = self.groupEnd(g) - start
+            for b in range(start, self.dataStart(g)):
+                used[b >> 3] |= 1 << (b & 7)
+            bitmap = bytearray(BLOCK_SIZE)
+            for i in range(count):
+                b = start + i
+                if used[b >> 3] & (1 << (b & 7)):
+                    bitmap[i >> 3] |= 1 << (i & 7)
+            free = count - sum([bin(x).count("1") for x in bitmap])
+            # bits past the end of the last group are marked as in use
+            for i in range(count, BLOCKS_PER_GROUP):
+                bitmap[i >> 3] |= 1 << (i & 7)
+            inodeBitmap = bytearray(BLOCK_SIZE)
+            first = g * self.inodesPerGroup
+            taken = max(0, min(inodes - first, self.inodesPerGroup))
+            for i in list(range(taken)) + list(range(self.inodesPerGroup, BLOCK_SIZE * 8)):
+                inodeBitmap[i >> 3] |= 1 << (i & 7)
+            freeInodes[g] -= taken
+            freeBlocks += free
+            self.f.seek(self.offset + self.blockBitmap(g) * BLOCK_SIZE)
+            self.f.write(bitmap + inodeBitmap)
+            descriptors += struct.pack("<3I4H12x", self.blockBitmap(g),
+                                       self.blockBitmap(g) + 1, self.inodeTable(g),
+                                       free, freeInodes[g], dirs[g], 0)
+
+        # superblock and group descriptors, with a backup in every group
+        now = int(time.time())
+        uuid = bytearray(os.urandom(16))
+        uuid[6] = (uuid[6] & 0x0f) | 0x40
+        uuid[8] = (uuid[8] & 0x3f) | 0x80
+        for g in range(self.groups):
+            sb = struct.pack("<13I6H4I2HI2H3I16s16s64sI", self.inodes, self.blocks,
+                             self.blocks * RESERVED_PERCENT // 100, freeBlocks,
+                             sum(freeInodes), 0, BLOCK_SIZE.bit_length() - 11,
+                             BLOCK_SIZE.bit_length() - 11, BLOCKS_PER_GROUP,
+                             BLOCKS_PER_GROUP, self.inodesPerGroup, 0, now, 0,
+                             0xffff, 0xef53, 1, 1, 0, now, 0, 0, 1, 0, 0,
+                             FIRST_INO, INODE_SIZE, g, 0,
+                             FEATURE_INCOMPAT_FILETYPE,
+                             FEATURE_RO_COMPAT_LARGE_FILE if large else 0,
+                             bytes(uuid), b"", b"", 0)
+            # the primary superblock follows the 1 KiB boot area
+            self.f.seek(self.offset + self.groupStart(g) * BLOCK_SIZE + (1024 if g == 0 else 0))
+            self.f.write(sb.ljust(1024, b"\0"))
+            self.f.seek(self.offset + (self.groupStart(g) + 1) * BLOCK_SIZE)
+            self.f.write(descriptors)
+
+        self.writePartitionTable()
+        self.f.close()
+        return (inodes, self.blocks - freeBlocks)
+
+    def writePartitionTable(self):
+        sectors = self.size // SECTOR_SIZE - PARTITION_START
+        mbr = bytearray(SECTOR_SIZE)
+        mbr[440:444] = os.urandom(4)
+        mbr[446:462] = struct.pack("<B3sB3sII", 0, chs(PARTITION_START), 0x83,
+                                   chs(PARTITION_START + sectors - 1),
+                                   PARTITION_START, sectors)
+        mbr[510:512] = b"\x55\xaa"
+        self.f.seek(0)
+        self.f.write(mbr)
+
+def chs(lba):
+    # cylinder/head/sector address for 255 heads and 63 sectors per track
+    (c, h, s) = (lba // (255 * 63), (lba // 63) % 255, lba % 63 + 1)
+    if c > 1023:
+        return b"\xfe\xff\xff"
+    return bytes(bytearray([h, ((c >> 2) & 0xc0) | s, c & 0xff]))
+
+def readFile(fs, path):
+    node = fs.resolve(path)[2]
+    if node is None or node.kind != stat.S_IFREG:
+        return None
+    return fs.readData(node)
+
+def writeFile(fs, path, data, mode=0o644):
+    (d, name, node) = fs.resolve(path, create=True)
+    if d is None or (node is not None and node.kind != stat.S_IFREG):
+        return
+    if node is None:
+        node = d.children[name] = Node(stat.S_IFREG, mode)
+    fs.setData(node, data)
+
+def makeDirs(fs, path):
+    (d, name, node) = fs.resolve(path, create=True)
+    if d is not None and node is None:
+        d.children[name] = Node(stat.S_IFDIR)
+
+def backupFile(fs, path):
+    (d, name, node) = fs.resolve(path)
+    if node is not None and node.kind == stat.S_IFREG:
+        print("Backing up %s to %s.bak" % (path, path))
+        copy = d.children[name + ".bak"] = Node(stat.S_IFREG, node.mode)
+        fs.setData(copy, fs.readData(node))
+
+def renameFile(fs, path, suffix=".bak"):
+    # like mv, this renames the entry itself if it is a symbolic link
+    node = fs.resolve(path)[2]
+    if node is not None and node.kind == stat.S_IFREG:
+        (d, name, node) = fs.resolve(path, follow=False)
+        if suffix:
+            print("Renaming %s to %s%s" % (path, path, suffix))
+            d.children[name + suffix] = node
+        else:
+            print("Removing %s" % path)
+        del d.children[name]
+
+def fixRootUser(data, shell=True):
+    # blanks the root password, and optionally sets the root shell
+    lines = []
+    for line in data.split(b"\n"):
+        fields = line.split(b":")
+        if fields[0] == b"root" and len(fields) > 2:
+            fields[1] = b""
+            if shell and fields[-1] and fields[-1] != b"/bin/sh":
+                fields[-1] = b"/bin/sh"
+        lines.append(b":".join(fields))
+    return b"\n".join(lines)
+
+def fixImage(fs):
+    # same changes as fixImage.sh, applied to the tree instead of in a chroot
+    makeDirs(fs, "/etc")
+    if not readFile(fs, "/etc/TZ"):
+        print("Creating /etc/TZ!")
+        writeFile(fs, "/etc/TZ", b"EST5EDT\n")
+
+    if not readFile(fs, "/etc/hosts"):
+        print("Creating /etc/hosts!")
+        writeFile(fs, "/etc/hosts", b"127.0.0.1 localhost\n")
+
+    passwd = readFile(fs, "/etc/passwd")
+    if not passwd:
+        print("Creating /etc/passwd!")
+        writeFile(fs, "/etc/passwd", ROOT_USER)
+    else:
+        backupFile(fs, "/etc/passwd")
+        backupFile(fs, "/etc/shadow")
+        if not [x for x in passwd.split(b"\n") if x.startswith(b"root:")]:
+            print("No root user found, creating root user with shell '/bin/sh'")
+            passwd = ROOT_USER
+            makeDirs(fs, "/root")
+        fixed = fixRootUser(passwd)
+        if fixed != passwd:
+            print("Fixing shell for root user, and blanking default root password")
+        if fixed != readFile(fs, "/etc/passwd"):
+            writeFile(fs, "/etc/passwd", fixed)
+        shadow = readFile(fs, "/etc/shadow")
+        if shadow and fixRootUser(shadow, False) != shadow:
+            writeFile(fs, "/etc/shadow", fixRootUser(shadow, False))
+
+    # recreate the default device nodes if /dev has fewer than 5 of them
+    makeDirs(fs, "/dev")
+    dev = fs.resolve("/dev")[2]
+    if dev is not None and dev.kind == stat.S_IFDIR and \
+            len([x for x in dev.children.values() if x.kind == stat.S_IFCHR]) < 5:
+        print("Warning: Recreating device nodes!")
+        for (path, mode, kind, major, minor) in DEVICES:
+            (d, name, node) = fs.resolve(path, create=True)
+            if d is not None and node is None:
+                node = d.children[name] = Node(kind, mode)
+                node.rdev = (major, minor)
+
+    # create a gpio file required for linksys to make the watchdog happy
+    for path in ["/bin/gpio", "/usr/lib/libcm.so", "/usr/lib/libshared.so"]:
+        if b"/dev/gpio/in" in (readFile(fs, path) or b""):
+            print("Creating /dev/gpio/in!")
+            makeDirs(fs, "/dev/gpio")
+            writeFile(fs, "/dev/gpio/in", b"\xff\xff\xff\xff")
+            break
+
+    # prevent system from rebooting
+    renameFile(fs, "/etc/scripts/sys_resetbutton", None)
+
+    # add some default nvram entries
+    binaries = dict()
+    for (path, key, value) in NVRAM_DEFAULTS:
+        if path not in binaries:
+            binaries[path] = readFile(fs, path) or b""
+        if key.encode() in binaries[path]:
+            print("Creating default %s!" % key)
+            writeFile(fs, "/firmadyne/libnvram.override/" + key, value)
+
+    renameFile(fs, "/etc/securetty")
+
+def build(infile, outfile, size, console=None, libnvram=None, preinit=None):
+    fs = Ext2Image(outfile, size)
+    try:
+        fs.addTarball(infile)
+        for path in ["/firmadyne", "/firmadyne/libnvram",
+                     "/firmadyne/libnvram.override"]:
+            makeDirs(fs, path)
+        fixImage(fs)
+        if console:
+            fs.addFile("/firmadyne/console", console)
+            tty = Node(stat.S_IFCHR, 0o666)
+            tty.rdev = (4, 65)
+            fs.add("/firmadyne/ttyS1", tty)
+        if libnvram:
+            fs.addFile("/firmadyne/libnvram.so", libnvram)
+        if preinit:
+            fs.addFile("/firmadyne/preInit.sh", preinit)
+        return fs.finish()
+    except BaseException:
+        fs.f.close()
+        os.unlink(outfile)
+        raise
+
+def main():
+    size = None
+    console = libnvram = preinit = None
+    opts, argv = getopt.getopt(sys.argv[1:], "s:c:l:p:")
+    for k, v in opts:
+        if k == '-s':
+            size = int(v)
+        if k == '-c':
+            console = v
+        if k == '-l':
+            libnvram = v
+        if k == '-p':
+            preinit = v
+
+    if size is None or len(argv) != 2:
+        print("Usage: buildImage.py -s <size> [-c <console>] [-l <libnvram.so>] [-p <preInit.sh>] <tarball> <image>")
+        sys.exit(1)
+
+    start = time.time()
+    try:
+        (inodes, blocks) = build(argv[0], argv[1], size, console, libnvram, preinit)
+    except ValueError as e:
+        print("Error: %s" % e)
+        sys.exit(1)
+    print("Built %s: %d inodes, %d blocks of %d bytes in %.3f s" % \
+          (argv[1], inodes, blocks, BLOCK_SIZE, time.time() - start))
+
+if __name__ == "__main__":
+    main()
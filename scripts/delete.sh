@@ -40,10 +40,11 @@ for i in 0 .. 4; do
     sudo ifconfig tap${IID}_${i} down
     sudo tunctl -d tap${IID}_${i}
 done
+sudo ip netns delete `get_netns ${IID}` 2> /dev/null || true
 
 #Cleanup database:
 echo "Remove the database entries ..."
-psql -d firmware -U firmadyne -h 127.0.0.1 -t -q -c "DELETE from image WHERE id=${IID};"
+"${SCRIPT_DIR}/firmadb.py" delete "${IID}"
 
 #Cleanup filesystem:
 echo "Clean up the file system ..."
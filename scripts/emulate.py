@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+
+import getopt
+import json
+import os
+import queue
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import firmadb
+
+# memory given to each guest, the additional memory used by QEMU itself, and
+# the memory left to the host, all in MiB
+GUEST_MEMORY = 256
+QEMU_OVERHEAD = 64
+HOST_RESERVE = 512
+
+# seconds that a stopped job is given for each signal, so that the cleanup
+# trap of run.sh can remove its network devices before it is killed
+GRACE_PERIOD = 30
+
+# seconds between status reports
+STATUS_INTERVAL = 10
+
+MODES = ["infer", "run"]
+
+def configValue(path, name):
+    # paths in firmadyne.config are only meaningful to the shell
+    return subprocess.check_output(["bash", "-c", 'source "$0" && echo "${%s}"' % name, path]).decode().strip()
+
+def hostMemory():
+    # available memory in MiB
+    with open("/proc/meminfo") as f:
+        for line in f:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) // 1024
+    return 0
+
+def poolSize(cpus, memory, guest=GUEST_MEMORY):
+    # one job per core, as long as every guest fits into memory
+    return max(1, min(cpus, (memory - HOST_RESERVE) // (guest + QEMU_OVERHEAD)))
+
+class Job(object):
+    def __init__(self, iid):
+        self.iid = iid
+        self.state = "queued"
+        self.attempts = 0
+        self.start = None
+        self.elapsed = 0
+        self.returncode = None
+        self.proc = None
+
+    def status(self):
+        elapsed = time.time() - self.start if self.state == "running" else self.elapsed
+        return {'iid' : self.iid, 'state' : self.state, 'attempts' : self.attempts,
+                'elapsed' : round(elapsed, 1), 'returncode' : self.returncode}
+
+class Scheduler(object):
+    # runs a queue of emulation jobs on a fixed number of worker threads, each
+    # job in its own process group so that it can be stopped as a whole
+    def __init__(self, iids, workers, mode="run", timeout=None, duration=None,
+                 retries=0, guest=GUEST_MEMORY, statusFile=None, netns=False):
+        self.config = os.path.abspath(firmadb.findConfig())
+        self.root = os.path.dirname(self.config)
+        self.scriptDir = configValue(self.config, "SCRIPT_DIR")
+        self.scratchDir = configValue(self.config, "SCRATCH_DIR")
+        self.jobs = [Job(x) for x in iids]
+        self.queue = queue.Queue()
+        for job in self.jobs:
+            self.queue.put(job)
+        self.workers = workers
+        self.mode = mode
+        self.timeout = timeout
+        self.duration = duration
+        self.retries = retries
+        self.guest = guest
+        self.statusFile = statusFile
+        self.netns = netns
+        self.stopping = False
+        self.lock = threading.Lock()
+
+    def command(self, iid):
+        if self.mode == "infer":
+            return [os.path.join(self.scriptDir, "inferNetwork.sh"), str(iid)]
+        return [os.path.join(self.scratchDir, str(iid), "run.sh")]
+
+    def log(self, job, message):
+        with self.lock:
+            print("%d: %s" % (job.iid, message))
+            sys.stdout.flush()
+
+    def stop(self, proc):
+        # signal the whole process group, escalating if it does not exit
+        for sig in [signal.SIGINT, signal.SIGTERM, signal.SIGKILL]:
+            try:
+                os.killpg(proc.pid, sig)
+            except OSError:
+                pass
+            try:
+                proc.wait(GRACE_PERIOD)
+                break
+            except subprocess.TimeoutExpired:
+                continue
+        self.sweep(proc)
+
+    def sweep(self, proc):
+        # the job itself has exited, so anything left in its process group
+        # has outlived its cleanup
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def runJob(self, job):
+        job.attempts += 1
+        job.returncode = None
+        job.start = time.time()
+        job.state = "running"
+        self.log(job, "running (attempt %d of %d)" % (job.attempts, self.retries + 1))
+
+        workDir = os.path.join(self.scratchDir, str(job.iid))
+        env = dict(os.environ)
+        env["QEMU_MEMORY"] = str(self.guest)
+        if self.netns:
+            # instances that share guest addresses cannot run side by side
+            # in the host namespace
+            env["FIRMADYNE_NETNS"] = "1"
+        try:
+            if not os.path.isdir(workDir):
+                os.makedirs(workDir)
+            with open(os.path.join(workDir, "emulate.log"), "a") as out:
+                job.proc = subprocess.Popen(self.command(job.iid), cwd=self.root,
+                                            env=env, stdin=subprocess.DEVNULL,
+                                            stdout=out, stderr=subprocess.STDOUT,
+                                            start_new_session=True)
+        except OSError as e:
+            job.elapsed = time.time() - job.start
+            job.state = "failed"
+            self.log(job, "failed: %s" % e)
+            return
+
+        state = None
+        while job.proc.poll() is None:
+            elapsed = time.time() - job.start
+            if self.stopping:
+                state = "stopped"
+            elif self.duration and elapsed >= self.duration:
+                # open-ended emulation that ran for as long as requested
+                state = "ok"
+            elif self.timeout and elapsed >= self.timeout:
+                state = "timeout"
+            if state:
+                self.stop(job.proc)
+                break
+            time.sleep(0.5)
+
+        if not state:
+            self.sweep(job.proc)
+        job.returncode = job.proc.returncode
+        job.elapsed = time.time() - job.start
+        job.proc = None
+        job.state = state or ("ok" if job.returncode == 0 else "failed")
+        self.log(job, "%s after %.1f s (exit status %s)" % \
+                 (job.state, job.elapsed, job.returncode))
+
+    def worker(self):
+        while not self.stopping:
+            try:
+                job = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            self.runJob(job)
+            if job.state in ["failed", "timeout"] and job.attempts <= self.retries \
+                    and not self.stopping:
+                job.state = "queued"
+                self.queue.put(job)
+
+    def status(self):
+        counts = dict()
+        for job in self.jobs:
+            counts[job.state] = counts.get(job.state, 0) + 1
+        return counts
+
+    def report(self):
+        counts = self.status()
+        running = ["%d (%.0f s)" % (x.iid, time.time() - x.start) \
+                   for x in self.jobs if x.state == "running"]
+        with self.lock:
+            print("Status: %s%s" % (", ".join(["%d %s" % (counts[x], x) for x in sorted(counts)]),
+                                    "; running: " + ", ".join(running) if running else ""))
+            sys.stdout.flush()
+        if self.statusFile:
+            # replaced atomically, so that it can be watched from elsewhere
+            tmp = self.statusFile + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump({'workers' : self.workers, 'counts' : counts,
+                           'jobs' : [x.status() for x in self.jobs]}, f, indent=1)
+            os.rename(tmp, self.statusFile)
+
+    def run(self):
+        threads = [threading.Thread(target=self.worker) for i in range(self.workers)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        try:
+            last = time.time()
+            while [t for t in threads if t.is_alive()]:
+                time.sleep(0.5)
+                if time.time() - last >= STATUS_INTERVAL:
+                    self.report()
+                    last = time.time()
+        except KeyboardInterrupt:
+            # running jobs are stopped by their workers, including cleanup
+            print("Stopping all jobs...")
+            self.stopping = True
+            for t in threads:
+                while t.is_alive():
+                    t.join(0.5)
+        self.report()
+        return all([x.state == "ok" for x in self.jobs])
+
+def readIids(path):
+    f = sys.stdin if path == "-" else open(path)
+    try:
+        return [int(x) for x in f.read().split()]
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def main():
+    iids = []
+    workers = None
+    cpus = os.cpu_count() or 1
+    memory = None
+    guest = GUEST_MEMORY
+    mode = "run"
+    timeout = duration = None
+    retries = 0
+    statusFile = None
+    netns = False
+    opts, argv = getopt.getopt(sys.argv[1:], "f:j:C:M:m:a:t:d:r:s:n")
+    for k, v in opts:
+        if k == '-f':
+            iids += readIids(v)
+        if k == '-j':
+            workers = int(v)
+        if k == '-C':
+            cpus = int(v)
+        if k == '-M':
+            memory = int(v)
+        if k == '-m':
+            guest = int(v)
+        if k == '-a':
+            mode = v
+        if k == '-t':
+            timeout = float(v)
+        if k == '-d':
+            duration = float(v)
+        if k == '-r':
+            retries = int(v)
+        if k == '-s':
+            statusFile = v
+        if k == '-n':
+            netns = True
+    iids += [int(x) for x in argv]
+
+    if not iids or mode not in MODES:
+        print("Usage: emulate.py [-a infer|run] [-j <jobs> | -C <cores> -M <memory MiB>] [-m <guest memory MiB>] [-t <timeout>] [-d <duration>] [-r <retries>] [-s <status file>] [-n] [-f <file with image IDs>] [<image ID> ...]")
+        sys.exit(1)
+
+    if not firmadb.findConfig():
+        print("Error: Could not find 'firmadyne.config'!")
+        sys.exit(1)
+
+    if workers is None:
+        workers = poolSize(cpus, memory if memory is not None else hostMemory(), guest)
+    workers = min(workers, len(iids))
+    print("Running %d jobs on %d workers" % (len(iids), workers))
+
+    scheduler = Scheduler(iids, workers, mode, timeout, duration, retries, guest,
+                          statusFile, netns)
+    if not scheduler.run():
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+import getopt
+import sys
+import time
+
+import firmadb
+
+INDEXES = [
+    ("object_to_image_oid_iid_idx",
+     "CREATE INDEX IF NOT EXISTS object_to_image_oid_iid_idx ON object_to_image USING btree (oid, iid)"),
+    ("object_to_image_filename_idx",
+     "CREATE INDEX IF NOT EXISTS object_to_image_filename_idx ON object_to_image USING btree (filename)"),
+    ("object_to_image_filename_trgm_idx",
+     "CREATE INDEX IF NOT EXISTS object_to_image_filename_trgm_idx ON object_to_image USING gin (filename gin_trgm_ops)"),
+]
+
+QUERIES = {
+    'hash' : """SELECT oi.iid, oi.filename, o.hash FROM object o JOIN object_to_image oi ON oi.oid = o.id WHERE o.hash = %s AND oi.regular_file ORDER BY oi.iid""",
+    'path' : """SELECT oi.iid, oi.filename, o.hash FROM object_to_image oi JOIN object o ON o.id = oi.oid WHERE oi.filename = %s ORDER BY oi.iid""",
+    'pattern' : """SELECT oi.iid, oi.filename, o.hash FROM object_to_image oi JOIN object o ON o.id = oi.oid WHERE oi.filename LIKE %s ORDER BY oi.iid""",
+}
+
+def ensureIndexes(dbh):
+    # the sqlite schema already includes these, except for the trigram index
+    if firmadb.backend(dbh) != "postgres":
+        return
+
+    cur = dbh.cursor()
+    cur.execute("SELECT indexname FROM pg_indexes WHERE tablename = 'object_to_image'")
+    existing = set([x[0] for x in cur.fetchall()])
+    for (name, query) in INDEXES:
+        if name in existing:
+            continue
+        print("Creating index %s..." % name)
+        try:
+            if name.endswith("_trgm_idx"):
+                cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            cur.execute(query)
+            dbh.commit()
+        except firmadb.Error as e:
+            # e.g. pg_trgm is not installed, or insufficient privileges
+            dbh.rollback()
+            print("Warning: Unable to create index %s: %s" % (name, e))
+    cur.close()
+
+def findFiles(dbh, kind, value):
+    # generator over (iid, filename, hash) rows, streamed from the server
+    return firmadb.iterQuery(dbh, "find_%s" % kind, QUERIES[kind], (value,))
+
+def main():
+    kind = value = None
+    host = None
+    indexes = True
+    opts, argv = getopt.getopt(sys.argv[1:], "m:p:l:s:n")
+    for k, v in opts:
+        if k == '-m':
+            (kind, value) = ('hash', v.lower())
+        if k == '-p':
+            (kind, value) = ('path', v)
+        if k == '-l':
+            (kind, value) = ('pattern', v)
+        if k == '-s':
+            host = v
+        if k == '-n':
+            indexes = False
+
+    if not kind:
+        print("Usage: findFile.py [-s <sql host>] [-n] -m <md5> | -p <path> | -l <LIKE pattern>")
+        sys.exit(1)
+
+    dbh = firmadb.connect(host)
+    if indexes:
+        ensureIndexes(dbh)
+
+    start = time.time()
+    first = None
+    count = 0
+    for (iid, filename, h) in findFiles(dbh, kind, value):
+        if first is None:
+            first = time.time() - start
+        count += 1
+        print("%d\t%s\t%s" % (iid, filename, h))
+    dbh.close()
+
+    sys.stderr.write("%d results in %.3f s (first result after %.3f s)\n" % \
+                     (count, time.time() - start, first or 0))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+import contextlib
+import os
+import re
+import sqlite3
+import sys
+import threading
+
+import sqlitedb
+
+# psycopg2 is only required for the postgres backend
+try:
+    import psycopg2
+    import psycopg2.pool
+except ImportError:
+    psycopg2 = None
+
+# connection settings, overridden by DB_* entries in firmadyne.config and then
+# by FIRMADYNE_DB_* environment variables
+DEFAULTS = {
+    'DB_BACKEND' : "postgres",
+    'DB_PATH' : os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                             "database", "firmware.sqlite"),
+    'DB_NAME' : "firmware",
+    'DB_USER' : "firmadyne",
+    'DB_PASS' : "firmadyne",
+    'DB_HOST' : "127.0.0.1",
+    'DB_PORT' : "5432",
+}
+
+# maximum number of connections kept by the shared pool
+POOL_SIZE = 8
+
+# number of rows fetched at a time by server-side cursors
+FETCH_SIZE = 2000
+
+_settings = None
+_pool = None
+_lock = threading.Lock()
+
+class BackendError(Exception):
+    # the configured backend cannot be used at all
+    pass
+
+# exceptions raised by either backend
+Error = (BackendError, sqlite3.Error, psycopg2.Error) if psycopg2 else \
+    (BackendError, sqlite3.Error)
+
+def findConfig():
+    if "FIRMADYNE_CONFIG" in os.environ:
+        return os.environ["FIRMADYNE_CONFIG"]
+    # same search order as the shell scripts, then relative to this file
+    for path in ["./firmadyne.config", "../firmadyne.config",
+                 os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "..", "firmadyne.config")]:
+        if os.path.exists(path):
+            return path
+    return None
+
+def readConfig(path):
+    result = dict()
+    with open(path) as f:
+        for line in f:
+            m = re.match(r"^\s*(DB_[A-Z]+)=[\"']?([^\"'#\s]*)", line)
+            if m:
+                result[m.group(1)] = m.group(2)
+    return result
+
+def getSettings():
+    global _settings
+    if _settings is None:
+        settings = dict(DEFAULTS)
+        path = findConfig()
+        if path:
+            settings.update(readConfig(path))
+        for k in DEFAULTS:
+            if "FIRMADYNE_" + k in os.environ:
+                settings[k] = os.environ["FIRMADYNE_" + k]
+        _settings = settings
+    return _settings
+
+def connectArgs(host=None):
+    settings = getSettings()
+    return {'database' : settings['DB_NAME'], 'user' : settings['DB_USER'],
+            'password' : settings['DB_PASS'],
+            'host' : host or settings['DB_HOST'],
+            'port' : int(settings['DB_PORT'])}
+
+def backend(obj=None):
+    # name of the backend of a connection or cursor, or the configured one
+    if obj is not None:
+        return getattr(obj, "backend", "postgres")
+    return getSettings()['DB_BACKEND']
+
+def requirePostgres():
+    if psycopg2 is None:
+        raise BackendError("psycopg2 is not installed")
+
+def connect(host=None):
+    if backend() == "sqlite":
+        return sqlitedb.Connection(getSettings()['DB_PATH'])
+    requirePostgres()
+    return psycopg2.connect(**connectArgs(host))
+
+def getPool(size=POOL_SIZE):
+    # the size only applies when the pool is created
+    global _pool
+    requirePostgres()
+    with _lock:
+        if _pool is None:
+            _pool = psycopg2.pool.ThreadedConnectionPool(1, max(1, size),
+                                                         **connectArgs())
+    return _pool
+
+@contextlib.contextmanager
+def pooled():
+    # borrow a connection from the shared pool; the transaction is committed
+    # if the block succeeds, and rolled back otherwise
+    if backend() == "sqlite":
+        dbh = connect()
+        try:
+            yield dbh
+            dbh.commit()
+        except BaseException:
+            dbh.rollback()
+            raise
+        finally:
+            dbh.close()
+        return
+
+    pool = getPool()
+    dbh = pool.getconn()
+    try:
+        yield dbh
+        dbh.commit()
+    except BaseException:
+        dbh.rollback()
+        raise
+    finally:
+        pool.putconn(dbh)
+
+def closePool():
+    global _pool
+    with _lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+def iterQuery(dbh, name, query, args=None, size=FETCH_SIZE):
+    # run a query on a named (server-side) cursor, so that large result sets
+    # are streamed instead of being held in memory at once
+    cur = dbh.cursor(name=name)
+    if backend(dbh) == "postgres":
+        cur.itersize = size
+    try:
+        cur.execute(query, args)
+        for row in cur:
+            yield row
+    finally:
+        cur.close()
+
+def getArch(cur, iid):
+    cur.execute("SELECT arch FROM image WHERE id=%s", (iid,))
+    row = cur.fetchone()
+    return row[0] if row and row[0] else None
+
+def setArch(cur, iid, arch):
+    cur.execute("UPDATE image SET arch=%s WHERE id=%s", (arch, iid))
+
+def getRootfsSize(cur, iid):
+    cur.execute("SELECT rootfs_size FROM image WHERE id=%s", (iid,))
+    row = cur.fetchone()
+    return row[0] if row and row[0] else None
+
+def setImageInfo(cur, iid, arch, size, inodes):
+    # keeps an existing architecture if none was detected
+    cur.execute("UPDATE image SET arch=COALESCE(%s, arch), rootfs_size=%s, rootfs_inodes=%s WHERE id=%s",
+                (arch, size, inodes, iid))
+
+# columns of the network table, in the order of the records of makeNetwork.py
+NETWORK_COLUMNS = ["idx", "nic", "ip", "dev", "bridge", "vlan", "mac"]
+
+def getNetwork(cur, iid):
+    # inferred network configuration, as one dict per interface
+    cur.execute("SELECT %s FROM network WHERE iid=%%s ORDER BY idx" % ", ".join(NETWORK_COLUMNS),
+                (iid,))
+    return [dict(zip(NETWORK_COLUMNS, row)) for row in cur.fetchall()]
+
+def setNetwork(cur, iid, records):
+    cur.execute("DELETE FROM network WHERE iid=%s", (iid,))
+    cur.executemany("INSERT INTO network (iid, %s) VALUES (%%s, %s)" % \
+                    (", ".join(NETWORK_COLUMNS), ", ".join(["%s"] * len(NETWORK_COLUMNS))),
+                    [[iid] + [x[k] for k in NETWORK_COLUMNS] for x in records])
+
+def getIP(cur, iid):
+    # address of the guest that run.sh routes to first
+    records = getNetwork(cur, iid)
+    return records[0]["ip"] if records else None
+
+def deleteImage(cur, iid):
+    # dependent rows are removed through ON DELETE CASCADE
+    cur.execute("DELETE FROM image WHERE id=%s", (iid,))
+
+def main():
+    # replacement for the psql invocations in the shell scripts
+    if len(sys.argv) == 3 and sys.argv[1] == "get-arch":
+        dbh = connect()
+        arch = getArch(dbh.cursor(), int(sys.argv[2]))
+        dbh.close()
+        if not arch:
+            sys.exit(1)
+        print(arch)
+    elif len(sys.argv) == 3 and sys.argv[1] == "get-rootfs-size":
+        dbh = connect()
+        size = getRootfsSize(dbh.cursor(), int(sys.argv[2]))
+        dbh.close()
+        if not size:
+            sys.exit(1)
+        print(size)
+    elif len(sys.argv) == 3 and sys.argv[1] == "get-ip":
+        dbh = connect()
+        ip = getIP(dbh.cursor(), int(sys.argv[2]))
+        dbh.close()
+        if not ip:
+            sys.exit(1)
+        print(ip)
+    elif len(sys.argv) == 4 and sys.argv[1] == "set-arch":
+        dbh = connect()
+        setArch(dbh.cursor(), int(sys.argv[2]), sys.argv[3])
+        dbh.commit()
+        dbh.close()
+    elif len(sys.argv) == 3 and sys.argv[1] == "delete":
+        dbh = connect()
+        deleteImage(dbh.cursor(), int(sys.argv[2]))
+        dbh.commit()
+        dbh.close()
+    else:
+        print("Usage: firmadb.py get-arch <image ID> | set-arch <image ID> <architecture> | get-rootfs-size <image ID> | get-ip <image ID> | delete <image ID>")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,8 @@
 #!/bin/sh
 
+# makeImage.sh applies the same changes with fixImage() in buildImage.py;
+# keep both in sync
+
 # use busybox statically-compiled version of all binaries
 BUSYBOX="/busybox"
 
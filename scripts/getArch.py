@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+import getopt
+import multiprocessing
+import os
+import re
+import struct
+import sys
+import tarfile
+
+import firmadb
+
+# ELF e_machine values, mapped to the architecture names used by getArch.sh
+MACHINES = {
+    3 : "intel",
+    8 : "mips",
+    10 : "mips",
+    20 : "ppc",
+    21 : "ppc",
+    40 : "arm",
+    62 : "intel64",
+    183 : "arm64",
+}
+
+# candidate executables, in the order in which they are considered
+CANDIDATES = [
+    ("busybox", re.compile(r"/busybox$")),
+    ("sbin", re.compile(r"/sbin/[A-Za-z]+")),
+    ("bin", re.compile(r"/bin/[A-Za-z]+")),
+]
+
+def elfArch(header):
+    # decodes the ELF identification and e_machine fields, e.g. "mipsel"
+    if len(header) < 20 or header[:4] != b"\x7fELF":
+        return None
+    if header[5] == 1:
+        (fmt, end) = ("<H", "el")
+    elif header[5] == 2:
+        (fmt, end) = (">H", "eb")
+    else:
+        return None
+    arch = MACHINES.get(struct.unpack(fmt, header[18:20])[0])
+    if not arch:
+        return None
+    if arch == "mips" and header[4] == 2:
+        arch = "mips64"
+    return arch + end
+
+def candidateKind(name):
+    for (kind, pattern) in CANDIDATES:
+        if pattern.search(name):
+            return kind
+    return None
+
+class ArchDetector(object):
+    # accumulates candidates seen while walking a tarball, so that detection
+    # can share a pass over the tarball with other processing
+    def __init__(self):
+        self.found = dict()
+
+    def wants(self, name):
+        kind = candidateKind(name)
+        return kind is not None and kind not in self.found
+
+    def done(self):
+        # nothing can take precedence over busybox
+        return "busybox" in self.found
+
+    def add(self, name, header):
+        kind = candidateKind(name)
+        if kind is None or kind in self.found:
+            return
+        arch = elfArch(header)
+        if arch:
+            self.found[kind] = (name, arch)
+
+    def result(self):
+        for (kind, pattern) in CANDIDATES:
+            if kind in self.found:
+                return self.found[kind]
+        return (None, None)
+
+def detectArch(infile):
+    # returns (member name, architecture) for the first usable candidate,
+    # reading the tarball once and only the ELF header of each candidate
+    detector = ArchDetector()
+    with tarfile.open(infile, "r|*") as t:
+        for f in t:
+            t.members = []
+            if f.isfile() and detector.wants(f.name):
+                detector.add(f.name, t.extractfile(f).read(64))
+                if detector.done():
+                    break
+    return detector.result()
+
+def getIid(infile):
+    m = re.search(r"(\d+)\.tar\.gz", infile)
+    if m:
+        return int(m.group(1))
+    return None
+
+def detectImage(infile):
+    # runs in a worker process in batch mode
+    try:
+        return (infile, detectArch(infile), None)
+    except Exception as e:
+        return (infile, (None, None), "%s: %s" % (type(e).__name__, e))
+
+def process(infiles, jobs=1, update=True):
+    dbh = cur = None
+    if update:
+        dbh = firmadb.connect()
+        cur = dbh.cursor()
+
+    if jobs > 1 and len(infiles) > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap(detectImage, infiles)
+    else:
+        pool = None
+        results = map(detectImage, infiles)
+
+    success = True
+    for (infile, (name, arch), error) in results:
+        if error:
+            print("%s: %s" % (infile, error))
+            success = False
+        elif not arch:
+            print("%s: unknown" % infile)
+            success = False
+        elif cur and getIid(infile) is None:
+            print("%s: no image ID in the file name" % infile)
+            success = False
+        else:
+            print("%s: %s" % (name, arch))
+            if cur:
+                firmadb.setArch(cur, getIid(infile), arch)
+                dbh.commit()
+
+    if pool:
+        pool.close()
+        pool.join()
+    if dbh:
+        dbh.close()
+    return success
+
+def main():
+    jobs = 1
+    update = True
+    opts, argv = getopt.getopt(sys.argv[1:], "j:n")
+    for k, v in opts:
+        if k == '-j':
+            jobs = int(v)
+        if k == '-n':
+            update = False
+
+    if not argv:
+        print("Usage: getArch.py [-n] [-j <jobs>] <tarball> [<tarball> ...]")
+        sys.exit(1)
+
+    if not process(argv, jobs, update):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
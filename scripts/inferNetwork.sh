@@ -27,8 +27,7 @@ if [ $# -gt 1 ]; then
     ARCH=${2}
 else
     echo -n "Querying database for architecture... "
-    ARCH=$(psql -d firmware -U firmadyne -h 127.0.0.1 -t -q -c "SELECT arch from image WHERE id=${1};")
-    ARCH="${ARCH#"${ARCH%%[![:space:]]*}"}"
+    ARCH=$("${SCRIPT_DIR}/firmadb.py" get-arch "${1}" || true)
     echo "${ARCH}"
     if [ -z "${ARCH}" ]; then
         echo "Error: Unable to lookup architecture. Please specify {armel,mipseb,mipsel} as the second argument!"
@@ -36,11 +35,21 @@ else
     fi
 fi
 
-echo "Running firmware ${IID}: terminating after 60 secs..."
-timeout --preserve-status --signal SIGINT 60 "${SCRIPT_DIR}/run.${ARCH}.sh" "${IID}"
-sleep 1
+# upper bound on the emulation time, and seconds that the inferred network
+# configuration must remain unchanged before the emulation is stopped early
+TIMEOUT=${INFER_TIMEOUT:-60}
+QUIET=${INFER_QUIET:-10}
+
+WORK_DIR=`get_scratch ${IID}`
+rm -f "${WORK_DIR}/qemu.initial.serial.log"
+
+echo "Running firmware ${IID}: terminating after ${TIMEOUT} secs, or once the network is stable for ${QUIET} secs..."
+timeout --preserve-status --signal SIGINT "${TIMEOUT}" "${SCRIPT_DIR}/run.${ARCH}.sh" "${IID}" &
+PID=$!
 
 echo "Inferring network..."
-"${SCRIPT_DIR}/makeNetwork.py" -i "${IID}" -q -o -a "${ARCH}" -S "${SCRATCH_DIR}"
+"${SCRIPT_DIR}/makeNetwork.py" -i "${IID}" -q -o -a "${ARCH}" -S "${SCRATCH_DIR}" \
+    -w "${PID}" -Q "${QUIET}" -t "${TIMEOUT}"
+wait "${PID}" || true
 
 echo "Done!"
@@ -18,11 +18,6 @@ if check_number $1; then
 fi
 IID=${1}
 
-if check_root; then
-    echo "Error: This script requires root privileges!"
-    exit 1
-fi
-
 if [ $# -gt 1 ]; then
     if check_arch "${2}"; then
         echo "Error: Invalid architecture!"
@@ -32,8 +27,7 @@ if [ $# -gt 1 ]; then
     ARCH=${2}
 else
     echo -n "Querying database for architecture... "
-    ARCH=$(psql -d firmware -U firmadyne -h 127.0.0.1 -t -q -c "SELECT arch from image WHERE id=${1};")
-    ARCH="${ARCH#"${ARCH%%[![:space:]]*}"}"
+    ARCH=$("${SCRIPT_DIR}/firmadb.py" get-arch "${1}" || true)
     echo "${ARCH}"
     if [ -z "${ARCH}" ]; then
         echo "Error: Unable to lookup architecture. Please specify {armel,mipseb,mipsel} as the second argument!"
@@ -44,7 +38,6 @@ fi
 echo "----Running----"
 WORK_DIR=`get_scratch ${IID}`
 IMAGE=`get_fs ${IID}`
-IMAGE_DIR=`get_fs_mount ${IID}`
 CONSOLE=`get_console ${ARCH}`
 LIBNVRAM=`get_nvram ${ARCH}`
 
@@ -60,7 +53,12 @@ if [ ! -e "${TARBALL_DIR}/${IID}.tar.gz" ]; then
 fi
 
 
-TARBALL_SIZE=$(tar ztvf "${TARBALL_DIR}/${IID}.tar.gz" --totals 2>&1 |tail -1|cut -f4 -d' ')
+# use the size recorded by tar2db.py -a if available, to avoid decompressing
+# the whole tarball just to size the disk image
+TARBALL_SIZE=$("${SCRIPT_DIR}/firmadb.py" get-rootfs-size "${IID}" || true)
+if [ -z "${TARBALL_SIZE}" ]; then
+    TARBALL_SIZE=$(tar ztvf "${TARBALL_DIR}/${IID}.tar.gz" --totals 2>&1 |tail -1|cut -f4 -d' ')
+fi
 MINIMUM_IMAGE_SIZE=$((TARBALL_SIZE + 10 * 1024 * 1024))
 echo "----The size of root filesystem '${TARBALL_DIR}/${IID}.tar.gz' is $TARBALL_SIZE-----"
 IMAGE_SIZE=8388608
@@ -69,61 +67,37 @@ do
     IMAGE_SIZE=$((IMAGE_SIZE*2))
 done
 
-echo "----Creating QEMU Image ${IMAGE} with size ${IMAGE_SIZE}----"
-qemu-img create -f raw "${IMAGE}" $IMAGE_SIZE
-chmod a+rw "${IMAGE}"
-
-echo "----Creating Partition Table----"
-echo -e "o\nn\np\n1\n\n\nw" | fdisk "${IMAGE}"
-
-echo "----Mounting QEMU Image----"
-DEVICE=$(get_device "$(kpartx -a -s -v "${IMAGE}")")
-sleep 1
-echo "----Device mapper created at ${DEVICE}----"
-
-echo "----Creating Filesystem----"
-mkfs.ext2 "${DEVICE}"
-sync
-
-echo "----Making QEMU Image Mountpoint at ${IMAGE_DIR}----"
-if [ ! -e "${IMAGE_DIR}" ]; then
-    mkdir "${IMAGE_DIR}"
-    chown "${USER}" "${IMAGE_DIR}"
+# base images are cached under a hash of everything that goes into them, so
+# that rebuilding an image with unchanged inputs is free, and images with the
+# same contents share one read-only copy on disk
+KEY=$( (sha256sum "${TARBALL_DIR}/${IID}.tar.gz" "${SCRIPT_DIR}/buildImage.py" \
+    "${SCRIPT_DIR}/fixImage.sh" "${SCRIPT_DIR}/preInit.sh" "${CONSOLE}" \
+    "${LIBNVRAM}" | cut -d ' ' -f 1; echo "${IMAGE_SIZE}") | sha256sum | cut -d ' ' -f 1)
+BASE=`get_cache_image ${KEY}`
+mkdir -p "${CACHE_DIR}"
+
+# serialize concurrent builds of the same base image
+exec 9>"${BASE}.lock"
+flock 9
+if [ -e "${BASE}" ]; then
+    echo "----Using cached QEMU Image ${BASE}----"
+else
+    echo "----Creating QEMU Image ${BASE} with size ${IMAGE_SIZE}----"
+    # builds the partition table and ext2 filesystem directly from the
+    # tarball, applying the changes from fixImage.sh and adding the FIRMADYNE
+    # files, so no root privileges, loop devices or mounts are needed
+    rm -f "${BASE}.tmp"
+    "${SCRIPT_DIR}/buildImage.py" -s "${IMAGE_SIZE}" -c "${CONSOLE}" \
+        -l "${LIBNVRAM}" -p "${SCRIPT_DIR}/preInit.sh" \
+        "${TARBALL_DIR}/${IID}.tar.gz" "${BASE}.tmp"
+    chmod a=r "${BASE}.tmp"
+    mv "${BASE}.tmp" "${BASE}"
 fi
+flock -u 9
+exec 9>&-
 
-echo "----Mounting QEMU Image Partition 1----"
-mount "${DEVICE}" "${IMAGE_DIR}"
-
-echo "----Extracting Filesystem Tarball to Mountpoint----"
-tar -xf "${TARBALL_DIR}/${IID}.tar.gz" -C "${IMAGE_DIR}"
-
-echo "----Creating FIRMADYNE Directories----"
-mkdir "${IMAGE_DIR}/firmadyne/"
-mkdir "${IMAGE_DIR}/firmadyne/libnvram/"
-mkdir "${IMAGE_DIR}/firmadyne/libnvram.override/"
-
-echo "----Patching Filesystem (chroot)----"
-cp $(which busybox) "${IMAGE_DIR}"
-cp "${SCRIPT_DIR}/fixImage.sh" "${IMAGE_DIR}"
-chroot "${IMAGE_DIR}" /busybox ash /fixImage.sh
-rm "${IMAGE_DIR}/fixImage.sh"
-rm "${IMAGE_DIR}/busybox"
-
-echo "----Setting up FIRMADYNE----"
-cp "${CONSOLE}" "${IMAGE_DIR}/firmadyne/console"
-chmod a+x "${IMAGE_DIR}/firmadyne/console"
-mknod -m 666 "${IMAGE_DIR}/firmadyne/ttyS1" c 4 65
-
-cp "${LIBNVRAM}" "${IMAGE_DIR}/firmadyne/libnvram.so"
-chmod a+x "${IMAGE_DIR}/firmadyne/libnvram.so"
-
-cp "${SCRIPT_DIR}/preInit.sh" "${IMAGE_DIR}/firmadyne/preInit.sh"
-chmod a+x "${IMAGE_DIR}/firmadyne/preInit.sh"
-
-echo "----Unmounting QEMU Image----"
-sync
-umount "${DEVICE}"
-echo "----Deleting device mapper----"
-kpartx -d "${IMAGE}"
-losetup -d "${DEVICE}" &>/dev/null
-dmsetup remove $(basename "$DEVICE") &>/dev/null
+echo "----Creating QEMU Overlay ${IMAGE}----"
+# emulation only ever writes to the overlay
+rm -f "${IMAGE}"
+qemu-img create -f qcow2 -F raw -b "${BASE}" "${IMAGE}"
+chmod a+rw "${IMAGE}"
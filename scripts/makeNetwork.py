@@ -7,6 +7,11 @@ import struct
 import socket
 import stat
 import os
+import mmap
+import signal
+import time
+
+import firmadb
 
 debug = 0
 
@@ -16,6 +21,7 @@ set -u
 
 ARCHEND=%(ARCHEND)s
 IID=%(IID)i
+GUESTIP=%(GUESTIP)s
 
 if [ -e ./firmadyne.config ]; then
     source ./firmadyne.config
@@ -34,12 +40,94 @@ QEMU=`get_qemu ${ARCHEND}`
 QEMU_MACHINE=`get_qemu_machine ${ARCHEND}`
 QEMU_ROOTFS=`get_qemu_disk ${ARCHEND}`
 WORK_DIR=`get_scratch ${IID}`
+PORTS=(`get_free_ports 4`)
+
+# every run writes to its own overlay on the image, which is deleted when the
+# run ends; snapshots can only be kept in the image itself, so runs with
+# FIRMADYNE_SNAPSHOT write to it directly, and only one at a time
+if [ -n "${FIRMADYNE_SNAPSHOT:-}" ]; then
+    if ! qemu-img info ${IMAGE} > /dev/null 2>&1; then
+        echo "Error: ${IMAGE} is in use by another run of image ${IID}!"
+        exit 1
+    fi
+    RUN_IMAGE=${IMAGE}
+else
+    RUN_IMAGE=`get_run_fs ${IID} $$`
+    qemu-img create -q -f qcow2 -F qcow2 -b `basename ${IMAGE}` ${RUN_IMAGE}
+fi
+
+# with FIRMADYNE_NETNS set, the instance runs in its own network namespace, so
+# that instances with the same addresses can run at the same time; use
+# scripts/netns.sh to run analyses inside it
+if [ -n "${FIRMADYNE_NETNS:-}" ]; then
+    NETNS=`get_netns ${IID}`
+    NS="sudo ip netns exec ${NETNS}"
+    QEMU_NS="sudo -E ip netns exec ${NETNS} sudo -E -u ${USER}"
+    echo "Creating network namespace ${NETNS}..."
+    sudo ip netns add ${NETNS}
+    ${NS} ip link set lo up
+else
+    NETNS=
+    NS="sudo"
+    QEMU_NS=
+fi
 
 %(START_NET)s
 
+# with FIRMADYNE_SNAPSHOT set, the state of the guest is saved into the disk
+# image once it answers on the network, and later runs resume from there
+# instead of booting; the snapshot is discarded when the kernel, the base
+# image, the memory size or this script change
+SNAPSHOT=firmadyne
+SNAPSHOT_KEY=`(sha256sum < ${KERNEL}; sha256sum < $0; qemu-img info ${IMAGE} | grep "^backing file:"; echo ${QEMU_MEMORY:-256}) | sha256sum | cut -d" " -f1`
+LOADVM=
+
+function has_snapshot {
+    qemu-img snapshot -l ${IMAGE} | grep -qw ${SNAPSHOT}
+}
+
+function take_snapshot {
+    DEADLINE=$((SECONDS + ${SNAPSHOT_TIMEOUT:-300}))
+    while [ ${SECONDS} -lt ${DEADLINE} ]; do
+        if ${NS} ping -c 1 -W 1 ${GUESTIP} > /dev/null 2>&1; then
+            # give the services of the firmware time to start
+            sleep ${SNAPSHOT_DELAY:-10}
+            echo "Saving snapshot ${SNAPSHOT}..."
+            if python3 ${SCRIPT_DIR}/monitor.py /tmp/qemu.${IID} "savevm ${SNAPSHOT}"; then
+                echo ${SNAPSHOT_KEY} > ${WORK_DIR}/snapshot.key
+            fi
+            return
+        fi
+        sleep 1
+    done
+    echo "Error: ${GUESTIP} did not answer, no snapshot saved!"
+}
+
+if [ -n "${FIRMADYNE_SNAPSHOT:-}" ]; then
+    if has_snapshot && [ "`cat ${WORK_DIR}/snapshot.key 2> /dev/null`" = "${SNAPSHOT_KEY}" ]; then
+        echo "Restoring snapshot ${SNAPSHOT}..."
+        LOADVM="-loadvm ${SNAPSHOT}"
+    else
+        if has_snapshot; then
+            echo "Deleting stale snapshot ${SNAPSHOT}..."
+            qemu-img snapshot -d ${SNAPSHOT} ${IMAGE}
+        fi
+        rm -f ${WORK_DIR}/snapshot.key
+        take_snapshot &
+    fi
+fi
+
 function cleanup {
     pkill -P $$
     %(STOP_NET)s
+    if [ "${RUN_IMAGE}" != "${IMAGE}" ]; then
+        rm -f ${RUN_IMAGE}
+    fi
+    if [ -n "${NETNS}" ]; then
+        echo "Deleting network namespace ${NETNS}..."
+        sudo ip netns pids ${NETNS} | xargs -r sudo kill
+        sudo ip netns delete ${NETNS}
+    fi
 }
 
 trap cleanup EXIT
@@ -47,87 +135,129 @@ trap cleanup EXIT
 echo "Starting firmware emulation... use Ctrl-a + x to exit"
 sleep 1s
 
-%(QEMU_ENV_VARS)s ${QEMU} -m 256 -M ${QEMU_MACHINE} -kernel ${KERNEL} \\
+%(QEMU_ENV_VARS)s ${QEMU_NS} ${QEMU} -m ${QEMU_MEMORY:-256} -M ${QEMU_MACHINE} -kernel ${KERNEL} \\
     %(QEMU_DISK)s -append "root=${QEMU_ROOTFS} console=ttyS0 nandsim.parts=64,64,64,64,64,64,64,64,64,64 rdinit=/firmadyne/preInit.sh rw debug ignore_loglevel print-fatal-signals=1 user_debug=31 firmadyne.syscall=0" \\
-    -nographic \\
+    -nographic -monitor unix:/tmp/qemu.${IID},server,nowait ${LOADVM} \\
     %(QEMU_NETWORK)s | tee ${WORK_DIR}/qemu.final.serial.log
 """
 
-def stripTimestamps(data):
-    lines = data.split("\n")
-    #throw out the timestamps
-    lines = [re.sub(r"^\[[^\]]*\] firmadyne: ", "", l) for l in lines]
-    return lines
-
-def findMacChanges(data, endianness):
-    lines = stripTimestamps(data)
-    candidates = filter(lambda l: l.startswith("ioctl_SIOCSIFHWADDR"), lines)
-    if debug:
-        print("Mac Changes %r" % candidates)
-
+# network configuration events logged by the instrumented kernel, optionally
+# after a timestamp; matched in a single pass over the raw serial log
+EVENT = re.compile(br"^(?:\[[^\]\n]*\] firmadyne: )?((?:__inet_insert_ifa|ioctl_SIOCSIFHWADDR|br_dev_ioctl|br_add_if|register_vlan_dev).*)$", re.M)
+
+PATTERNS = [
+    ("ifa", re.compile(r"^__inet_insert_ifa\[[^\]]+\]: device:([^ ]+) ifa:0x([0-9a-f]+)")),
+    ("mac", re.compile(r"^ioctl_SIOCSIFHWADDR\[[^\]]+\]: dev:([^ ]+) mac:0x([0-9a-f]+) 0x([0-9a-f]+)")),
+    ("bridge", re.compile(r"^(?:br_dev_ioctl|br_add_if)\[[^\]]+\]: br:([^ ]+) dev:(.*)")),
+    ("vlan", re.compile(r"^register_vlan_dev\[[^\]]+\]: dev:([^ ]+) vlan_id:([0-9]+)")),
+]
+
+# characters that made device names behave as patterns in the old per-device
+# regular expressions
+SPECIAL = re.compile(r"[.^$*+?{}\[\]\\|()]")
+
+# messages after which the guest will not make further progress, checked in
+# order since init exiting also causes a panic
+FATAL = [
+    ("init-exited", re.compile(br"Attempted to kill init!")),
+    ("panic", re.compile(br"Kernel panic - not syncing")),
+]
+
+# live mode: seconds without changes to the inferred network before the
+# emulation is stopped, and how often the serial log is polled
+QUIET_PERIOD = 10
+POLL_INTERVAL = 0.5
+
+class NetworkEvents(object):
+    # index of events keyed by event type and device, each entry holding its
+    # position in the log so that the original order can be recovered
+    def __init__(self):
+        self.index = dict()
+        self.count = 0
+
+    def feed(self, data):
+        # data must consist of complete lines
+        for m in EVENT.finditer(data):
+            line = m.group(1).decode("utf-8", "replace")
+            for (event, pattern) in PATTERNS:
+                g = pattern.match(line)
+                if g:
+                    self.add(event, g.group(1), g.groups()[1:])
+                    break
+
+    def add(self, event, dev, value):
+        self.index.setdefault(event, dict()).setdefault(dev, []).append((self.count, value))
+        self.count += 1
+
+    def all(self, event):
+        # [(device, value)] for all devices, in log order
+        entries = [(pos, dev, value) for (dev, values) in self.index.get(event, dict()).items() \
+                   for (pos, value) in values]
+        entries.sort()
+        return [(dev, value) for (pos, dev, value) in entries]
+
+    def lookup(self, event, dev):
+        # [value] for a device, in log order
+        devices = self.index.get(event, dict())
+        if not SPECIAL.search(dev):
+            return [value for (pos, value) in devices.get(dev, [])]
+        pattern = re.compile("(?:%s)\\Z" % dev)
+        entries = [x for (k, values) in devices.items() if pattern.match(k) for x in values]
+        entries.sort()
+        return [value for (pos, value) in entries]
+
+def parseLog(infile):
+    events = NetworkEvents()
+    with open(infile, "rb") as f:
+        if os.fstat(f.fileno()).st_size:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                events.feed(data)
+            finally:
+                data.close()
+    return events
+
+def findMacChanges(events, endianness):
     result = []
     if endianness == "eb":
         fmt = ">I"
     elif endianness == "el":
         fmt = "<I"
-    for c in candidates:
-        g = re.match(r"^ioctl_SIOCSIFHWADDR\[[^\]]+\]: dev:([^ ]+) mac:0x([0-9a-f]+) 0x([0-9a-f]+)", c)
-        if g:
-            (iface, mac0, mac1) = g.groups()
-            m0 = struct.pack(fmt, int(mac0, 16))[2:]
-            m1 = struct.pack(fmt, int(mac1, 16))
-            mac = "%02x:%02x:%02x:%02x:%02x:%02x" % struct.unpack("BBBBBB", m0+m1)
-            result.append((iface, mac))
+    for (iface, (mac0, mac1)) in events.all("mac"):
+        m0 = struct.pack(fmt, int(mac0, 16))[2:]
+        m1 = struct.pack(fmt, int(mac1, 16))
+        mac = "%02x:%02x:%02x:%02x:%02x:%02x" % struct.unpack("BBBBBB", m0+m1)
+        result.append((iface, mac))
+    if debug:
+        print("Mac Changes %r" % result)
     return result
 
 # Get the network interfaces in the router, except 127.0.0.0/8
-def findNonLoInterfaces(data, endianness):
-    #lines = data.split("\r\n")
-    lines = stripTimestamps(data)
-    candidates = filter(lambda l: l.startswith("__inet_insert_ifa"), lines) # logs for the inconfig process
+def findNonLoInterfaces(events, endianness):
     if debug:
-        print("Candidate ifaces: %r" % candidates)
+        print("Candidate ifaces: %r" % events.all("ifa"))
     result = []
     if endianness == "eb":
         fmt = ">I"
     elif endianness == "el":
         fmt = "<I"
-    for c in candidates:
-        g = re.match(r"^__inet_insert_ifa\[[^\]]+\]: device:([^ ]+) ifa:0x([0-9a-f]+)", c)
-        if g:
-            (iface, addr) = g.groups()
-            addr = socket.inet_ntoa(struct.pack(fmt, int(addr, 16)))
-            if (not addr.startswith("127.")) and addr != "0.0.0.0":
-                result.append((iface, addr))
+    for (iface, (addr,)) in events.all("ifa"):
+        addr = socket.inet_ntoa(struct.pack(fmt, int(addr, 16)))
+        if (not addr.startswith("127.")) and addr != "0.0.0.0":
+            result.append((iface, addr))
     return result
 
-def findIfacesForBridge(data, brif):
-    #lines = data.split("\r\n")
-    lines = stripTimestamps(data)
+def findIfacesForBridge(events, brif):
     result = []
-    candidates = filter(lambda l: l.startswith("br_dev_ioctl") or l.startswith("br_add_if"), lines)
-    for c in candidates:
-        for p in [r"^br_dev_ioctl\[[^\]]+\]: br:%s dev:(.*)", r"^br_add_if\[[^\]]+\]: br:%s dev:(.*)"]:
-            pat = p % brif
-            g = re.match(pat, c)
-            if g:
-                iface = g.group(1)
-                #we only add it if the interface is not the bridge itself
-                #there are images that call brctl addif br0 br0 (e.g., 5152)
-                if iface != brif:
-                    result.append(iface.strip())
+    for (iface,) in events.lookup("bridge", brif):
+        #we only add it if the interface is not the bridge itself
+        #there are images that call brctl addif br0 br0 (e.g., 5152)
+        if iface != brif:
+            result.append(iface.strip())
     return result
 
-def findVlanInfoForDev(data, dev):
-    #lines = data.split("\r\n")
-    lines = stripTimestamps(data)
-    results = []
-    candidates = filter(lambda l: l.startswith("register_vlan_dev"), lines)
-    for c in candidates:
-        g = re.match(r"register_vlan_dev\[[^\]]+\]: dev:%s vlan_id:([0-9]+)" % dev, c)
-        if g:
-            results.append(int(g.group(1)))
-    return results
+def findVlanInfoForDev(events, dev):
+    return [int(vlan) for (vlan,) in events.lookup("vlan", dev)]
 
 def ifaceNo(dev):
     g = re.match(r"[^0-9]+([0-9]+)", dev)
@@ -136,9 +266,9 @@ def ifaceNo(dev):
 def qemuArchNetworkConfig(i, arch, n):
     if not n:
         if arch == "arm":
-            return "-device virtio-net-device,netdev=net%(I)i -netdev socket,id=net%(I)i,listen=:200%(I)i" % {'I': i}
+            return "-device virtio-net-device,netdev=net%(I)i -netdev socket,id=net%(I)i,listen=:${PORTS[%(I)i]}" % {'I': i}
         else:
-            return "-netdev socket,id=net%(I)i,listen=:200%(I)i -device e1000,netdev=net%(I)i" % {'I': i}
+            return "-netdev socket,id=net%(I)i,listen=:${PORTS[%(I)i]} -device e1000,netdev=net%(I)i" % {'I': i}
     else:
         (ip, dev, vlan, mac) = n
          # newer kernels use virtio only
@@ -149,7 +279,9 @@ def qemuArchNetworkConfig(i, arch, n):
             mac_str = "" if not mac else ",mac=%s" % mac
             return "-netdev tap,id=nettap%(I)i,ifname=${TAPDEV_%(I)i},script=no -device e1000,netdev=nettap%(I)i%(MAC)s" % { 'I' : i, 'MAC' : mac_str}
 
-def qemuNetworkConfig(arch, network):
+def nicMapping(network, warn=True):
+    # QEMU NICs in order, as (index, interface) pairs; placeholders for NICs
+    # without an interface are (index, None)
     output = []
     assigned = []
 
@@ -159,7 +291,7 @@ def qemuNetworkConfig(arch, network):
         for j, n in enumerate(network):
             # need to connect the jth emulated network interface to the corresponding host interface
             if k == ifaceNo(n[1]):
-                output.append(qemuArchNetworkConfig(j, arch, n))
+                output.append((j, n))
                 assigned.append(n)
                 flag = j
                 break
@@ -168,17 +300,53 @@ def qemuNetworkConfig(arch, network):
         if i != flag:
             # otherwise, put placeholder socket connection
             if len(output) <= i:
-                output.append(qemuArchNetworkConfig(i, arch, None))
+                output.append((i, None))
 
     # find unassigned interfaces
     for j, n in enumerate(network):
         if n not in assigned:
             # guess assignment
-            print("Warning: Unmatched interface: %s" % (n,))
-            output[j] = qemuArchNetworkConfig(j, arch, n)
+            if warn:
+                print("Warning: Unmatched interface: %s" % (n,))
+            output[j] = (j, n)
             assigned.append(n)
 
-    return ' '.join(output)
+    return output
+
+def qemuNetworkConfig(arch, network):
+    return ' '.join([qemuArchNetworkConfig(i, arch, n) for (i, n) in nicMapping(network)])
+
+def networkRecords(data, network, endianness):
+    # structured form of the inferred configuration, as stored in the network
+    # table; the order of the records is the order of the TAP devices
+    ifaces = findNonLoInterfaces(data, endianness)
+    nics = dict([(i, pos) for (pos, (i, n)) in enumerate(nicMapping(network, False)) if n])
+    records = []
+    for i, (ip, dev, vlan, mac) in enumerate(network):
+        records.append({'idx' : i, 'nic' : nics.get(i), 'ip' : ip, 'dev' : dev,
+                        'bridge' : findBridge(data, ifaces, ip, dev),
+                        'vlan' : vlan, 'mac' : mac})
+    return records
+
+def findBridge(data, ifaces, ip, dev):
+    # the bridge that carries the address of dev, if any; dev has its VLAN
+    # suffix stripped, as in buildConfig
+    for (br, addr) in ifaces:
+        if addr == ip and br != dev and \
+                dev in [x.split(".")[0] for x in findIfacesForBridge(data, br)]:
+            return br
+    return None
+
+def recordsNetwork(records):
+    return [(x['ip'], x['dev'], x['vlan'], x['mac']) for x in records]
+
+def loadNetwork(iid):
+    with firmadb.pooled() as dbh:
+        return firmadb.getNetwork(dbh.cursor(), iid)
+
+def storeNetwork(iid, records):
+    with firmadb.pooled() as dbh:
+        firmadb.setNetwork(dbh.cursor(), iid, records)
 
 def buildConfig(brif, iface, vlans, macs):
     #there should be only one ip
@@ -215,23 +383,25 @@ def startNetwork(network):
 TAPDEV_%(I)i=tap${IID}_%(I)i
 HOSTNETDEV_%(I)i=${TAPDEV_%(I)i}
 echo "Creating TAP device ${TAPDEV_%(I)i}..."
-sudo tunctl -t ${TAPDEV_%(I)i} -u ${USER}
+${NS} tunctl -t ${TAPDEV_%(I)i} -u ${USER}
+# fixed address, so that ARP caches in restored snapshots stay valid
+${NS} ip link set ${TAPDEV_%(I)i} address `printf "02:fd:%%02x:%%02x:%%02x:%%02x" $((IID >> 16 & 255)) $((IID >> 8 & 255)) $((IID & 255)) %(I)i`
 """
 
     template_vlan = """
 echo "Initializing VLAN..."
 HOSTNETDEV_%(I)i=${TAPDEV_%(I)i}.%(VLANID)i
-sudo ip link add link ${TAPDEV_%(I)i} name ${HOSTNETDEV_%(I)i} type vlan id %(VLANID)i
-sudo ip link set ${TAPDEV_%(I)i} up
+${NS} ip link add link ${TAPDEV_%(I)i} name ${HOSTNETDEV_%(I)i} type vlan id %(VLANID)i
+${NS} ip link set ${TAPDEV_%(I)i} up
 """
 
     template_2 = """
 echo "Bringing up TAP device..."
-sudo ip link set ${HOSTNETDEV_%(I)i} up
-sudo ip addr add %(HOSTIP)s/24 dev ${HOSTNETDEV_%(I)i}
+${NS} ip link set ${HOSTNETDEV_%(I)i} up
+${NS} ip addr add %(HOSTIP)s/24 dev ${HOSTNETDEV_%(I)i}
 
 echo "Adding route to %(GUESTIP)s..."
-sudo ip route add %(GUESTIP)s via %(GUESTIP)s dev ${HOSTNETDEV_%(I)i}
+${NS} ip route add %(GUESTIP)s via %(GUESTIP)s dev ${HOSTNETDEV_%(I)i}
 """
 
     output = []
@@ -245,20 +415,20 @@ sudo ip route add %(GUESTIP)s via %(GUESTIP)s dev ${HOSTNETDEV_%(I)i}
 def stopNetwork(network):
     template_1 = """
 echo "Deleting route..."
-sudo ip route flush dev ${HOSTNETDEV_%(I)i}
+${NS} ip route flush dev ${HOSTNETDEV_%(I)i}
 
 echo "Bringing down TAP device..."
-sudo ip link set ${TAPDEV_%(I)i} down
+${NS} ip link set ${TAPDEV_%(I)i} down
 """
 
     template_vlan = """
 echo "Removing VLAN..."
-sudo ip link delete ${HOSTNETDEV_%(I)i}
+${NS} ip link delete ${HOSTNETDEV_%(I)i}
 """
 
     template_2 = """
 echo "Deleting TAP device ${TAPDEV_%(I)i}..."
-sudo tunctl -d ${TAPDEV_%(I)i}
+${NS} tunctl -d ${TAPDEV_%(I)i}
 """
 
     output = []
@@ -272,11 +442,11 @@ sudo tunctl -d ${TAPDEV_%(I)i}
 def qemuCmd(iid, network, arch, endianness):
     if arch == "mips":
         qemuEnvVars = ""
-        qemuDisk = "-drive if=ide,format=raw,file=${IMAGE}"
+        qemuDisk = "-drive if=ide,format=qcow2,file=${RUN_IMAGE}"
         if endianness != "eb" and endianness != "el":
             raise Exception("You didn't specify a valid endianness")
     elif arch == "arm":
-        qemuDisk = "-drive if=none,file=${IMAGE},format=raw,id=rootfs -device virtio-blk-device,drive=rootfs"
+        qemuDisk = "-drive if=none,file=${RUN_IMAGE},format=qcow2,id=rootfs -device virtio-blk-device,drive=rootfs"
         if endianness == "el":
             qemuEnvVars = "QEMU_AUDIO_DRV=none"
         elif endianness == "eb":
@@ -287,6 +457,7 @@ def qemuCmd(iid, network, arch, endianness):
         raise Exception("Unsupported architecture")
 
     return QEMUCMDTEMPLATE % {'IID': iid,
+                              'GUESTIP' : network[0][0] if network else "",
                               'ARCHEND' : arch + endianness,
                               'START_NET' : startNetwork(network),
                               'STOP_NET' : stopNetwork(network),
@@ -294,13 +465,10 @@ def qemuCmd(iid, network, arch, endianness):
                               'QEMU_NETWORK' : qemuNetworkConfig(arch, network),
                               'QEMU_ENV_VARS' : qemuEnvVars}
 
-def process(infile, iid, arch, endianness=None, makeQemuCmd=False, outfile=None):
+def inferNetwork(data, endianness):
     brifs = []
     vlans = []
-    data = open(infile,"rb").read()
-    data = data.decode('utf-8', 'replace')
     network = set()
-    success = False
 
     #find interfaces with non loopback ip addresses
     ifacesWithIps = findNonLoInterfaces(data, endianness)
@@ -308,8 +476,6 @@ def process(infile, iid, arch, endianness=None, makeQemuCmd=False, outfile=None)
     #find changes of mac addresses for devices
     macChanges = findMacChanges(data, endianness)
 
-    print("Interfaces: %r" % ifacesWithIps)
-
     deviceHasBridge = False
     for iwi in ifacesWithIps:
         #find all interfaces that are bridged with that interface
@@ -337,18 +503,112 @@ def process(infile, iid, arch, endianness=None, makeQemuCmd=False, outfile=None)
         else:
             if debug:
                 print("duplicate ip address for interface: ", n)
+    return pruned_network
+
+def isRunning(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    # exited, but not yet reaped by the parent shell
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            return f.read().rsplit(")", 1)[-1].split()[0] != "Z"
+    except IOError:
+        return True
+
+def stopEmulation(pid, wait=10):
+    # the emulation is started under timeout(1), which runs it in its own
+    # process group, so this reaches QEMU as well
+    try:
+        os.killpg(pid, signal.SIGINT)
+    except OSError:
+        return
+    end = time.time() + wait
+    while isRunning(pid) and time.time() < end:
+        time.sleep(0.1)
+
+def follow(infile, pid, endianness, quiet=QUIET_PERIOD, timeout=None):
+    # follows the serial log of a running emulation, feeding events into the
+    # inference as they arrive, and stops the emulation once the inferred
+    # network has not changed for quiet seconds, or right away if the guest
+    # cannot make further progress; returns a reason code
+    data = NetworkEvents()
+    start = changed = time.time()
+    network = None
+    rest = b""
+    f = None
+    try:
+        while True:
+            if f is None and os.path.exists(infile):
+                f = open(infile, "rb")
+            if f is not None:
+                buf = rest + f.read()
+                end = buf.rfind(b"\n") + 1
+                (lines, rest) = (buf[:end], buf[end:])
+                for (reason, pattern) in FATAL:
+                    if pattern.search(lines):
+                        stopEmulation(pid)
+                        return reason
+                if lines:
+                    data.feed(lines)
+                    current = frozenset(inferNetwork(data, endianness))
+                    if current != network:
+                        if debug:
+                            print("Network after %.1f s: %r" % (time.time() - start, sorted(current, key=repr)))
+                        network = current
+                        changed = time.time()
+
+            now = time.time()
+            if not isRunning(pid):
+                return "timeout" if timeout and now - start >= timeout else "exited"
+            if network and now - changed >= quiet:
+                stopEmulation(pid)
+                return "stable"
+            time.sleep(POLL_INTERVAL)
+    finally:
+        if f is not None:
+            f.close()
+
+def process(infile, iid, arch, endianness=None, makeQemuCmd=False, outfile=None,
+            cached=False, store=True):
+    success = False
+    qemuCommandLine = None
+
+    records = None
+    if cached and iid:
+        # configuration stored by an earlier run, without reading the log
+        try:
+            records = loadNetwork(iid)
+        except firmadb.Error as e:
+            print("Warning: Could not load network configuration: %s" % e)
+        if records:
+            print("Using stored network configuration of image %d" % iid)
+            store = False
+    if not records:
+        data = parseLog(infile)
+        print("Interfaces: %r" % findNonLoInterfaces(data, endianness))
+        records = networkRecords(data, inferNetwork(data, endianness), endianness)
+    pruned_network = recordsNetwork(records)
 
     if makeQemuCmd:
         qemuCommandLine = qemuCmd(iid, pruned_network, arch, endianness)
     if qemuCommandLine:
         success = True
-    if outfile:
+    if outfile and qemuCommandLine:
         with open(outfile, "w") as out:
             out.write(qemuCommandLine)
         os.chmod(outfile, stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH)
-    else:
+    elif qemuCommandLine:
         print(qemuCommandLine)
 
+    # only after run.sh is written, since it does not need the database
+    if store and iid:
+        try:
+            storeNetwork(iid, records)
+        except firmadb.Error as e:
+            print("Warning: Could not store network configuration: %s" % e)
+
     return success
 
 def archEnd(value):
@@ -362,7 +622,12 @@ def main():
     outfile = None
     arch = None
     endianness = None
-    (opts, argv) = getopt.getopt(sys.argv[1:], 'f:i:S:a:oqd')
+    pid = None
+    quiet = QUIET_PERIOD
+    timeout = None
+    cached = False
+    store = True
+    (opts, argv) = getopt.getopt(sys.argv[1:], 'f:i:S:a:oqdw:Q:t:cn')
     for (k, v) in opts:
         if k == '-f':
             infile = v
@@ -379,6 +644,16 @@ def main():
             outfile = True
         if k == '-a':
             (arch, endianness) = archEnd(v)
+        if k == '-w':
+            pid = int(v)
+        if k == '-Q':
+            quiet = float(v)
+        if k == '-t':
+            timeout = float(v)
+        if k == '-c':
+            cached = True
+        if k == '-n':
+            store = False
 
     if not arch or not endianness:
         raise Exception("Either arch or endianness not found try mipsel/mipseb/armel/armeb")
@@ -389,8 +664,12 @@ def main():
         outfile = """%s/%i/run.sh""" % (SCRATCHDIR, iid)
     if debug:
         print("processing %i" % iid)
+    if infile and pid:
+        start = time.time()
+        reason = follow(infile, pid, endianness, quiet, timeout)
+        print("Emulation stopped after %.1f s: %s" % (time.time() - start, reason))
     if infile:
-        process(infile, iid, arch, endianness, makeQemuCmd, outfile)
+        process(infile, iid, arch, endianness, makeQemuCmd, outfile, cached, store)
 
 if __name__ == "__main__":
     main()
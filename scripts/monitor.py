@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import getopt
+import socket
+import sys
+import time
+
+PROMPT = b"(qemu) "
+
+# seconds to wait for a command; savevm of a large guest takes a while
+TIMEOUT = 120
+
+def readPrompt(sock, deadline):
+    data = b""
+    while not data.endswith(PROMPT):
+        sock.settimeout(max(0.1, deadline - time.time()))
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise EOFError("monitor closed the connection")
+        data += chunk
+    return data[:-len(PROMPT)]
+
+def cleanOutput(data):
+    # the monitor echoes the command line with terminal escapes, so only the
+    # lines after it are output
+    lines = data.decode("utf-8", "replace").replace("\r", "").split("\n")
+    return "\n".join(lines[1:]).strip()
+
+def monitorCommand(path, command, timeout=TIMEOUT):
+    # runs a human monitor command on the unix socket of a QEMU instance
+    deadline = time.time() + timeout
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        readPrompt(sock, deadline)
+        sock.sendall(command.encode() + b"\n")
+        return cleanOutput(readPrompt(sock, deadline))
+    finally:
+        sock.close()
+
+def main():
+    timeout = TIMEOUT
+    opts, argv = getopt.getopt(sys.argv[1:], "t:")
+    for k, v in opts:
+        if k == '-t':
+            timeout = float(v)
+
+    if len(argv) != 2:
+        print("Usage: monitor.py [-t <timeout>] <monitor socket> <command>")
+        sys.exit(1)
+
+    try:
+        output = monitorCommand(argv[0], argv[1], timeout)
+    except (OSError, EOFError) as e:
+        print("Error: %s" % e)
+        sys.exit(1)
+
+    if output:
+        print(output)
+    # failed commands only report their errors as text
+    if output.startswith("Error") or "\nError" in output:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
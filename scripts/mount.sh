@@ -29,7 +29,12 @@ IMAGE=`get_fs ${IID}`
 IMAGE_DIR=`get_fs_mount ${IID}`
 
 echo "----Adding Device File----"
-DEVICE=$(get_device "$(kpartx -a -s -v "${IMAGE}")")
+# the image is a qcow2 overlay, so it is attached with qemu-nbd
+modprobe nbd max_part=8
+NBD=`get_nbd`
+qemu-nbd --connect="${NBD}" "${IMAGE}"
+echo "${NBD}" > "${WORK_DIR}/nbd"
+DEVICE="${NBD}p1"
 sleep 1
 
 if [ ! -e "${IMAGE_DIR}" ]
@@ -39,7 +44,6 @@ then
 fi
 
 echo "----Mounting ${DEVICE}----"
-#sudo /bin/mount /dev/nbd0p1 "${IMAGE_DIR}"
 mount "${DEVICE}" "${IMAGE_DIR}"
 
 echo "----Mounted at ${IMAGE_DIR}----"
@@ -0,0 +1,30 @@
+#!/bin/bash
+
+set -e
+set -u
+
+if [ -e ./firmadyne.config ]; then
+    source ./firmadyne.config
+elif [ -e ../firmadyne.config ]; then
+    source ../firmadyne.config
+else
+    echo "Error: Could not find 'firmadyne.config'!"
+    exit 1
+fi
+
+if [ $# -lt 2 ] || check_number $1; then
+    echo "Usage: netns.sh <image ID> <command> [<argument> ...]"
+    echo "Runs an analysis inside the network namespace of an instance that was started with FIRMADYNE_NETNS set."
+    exit 1
+fi
+IID=${1}
+shift
+
+NETNS=`get_netns ${IID}`
+if ! ip netns list | grep -qw "^${NETNS}"; then
+    echo "Error: Network namespace ${NETNS} does not exist!"
+    exit 1
+fi
+
+# the command runs as the calling user, with the environment of this script
+exec sudo -E ip netns exec "${NETNS}" sudo -E -u "${USER}" "$@"
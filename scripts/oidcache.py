@@ -0,0 +1,93 @@
+import sqlite3
+import time
+
+# default number of hashes kept in the cache, and the size of the region of
+# the cache file that is memory-mapped
+MAX_ENTRIES = 1000000
+MMAP_SIZE = 256 * 1024 * 1024
+
+# maximum number of parameters bound to a single sqlite query
+QUERY_SIZE = 500
+
+class OidCache(object):
+    # local cache of md5 -> object.id mappings, stored in a memory-mapped
+    # sqlite file and bounded by evicting the least recently used hashes
+    def __init__(self, path, maxEntries=MAX_ENTRIES):
+        self.path = path
+        self.maxEntries = maxEntries
+        self.hits = self.misses = 0
+        self.pending = dict()
+        self._db = None
+
+    @property
+    def db(self):
+        # opened on first use, so that a cache created before worker
+        # processes are forked never shares its connection with them
+        if self._db is None:
+            db = sqlite3.connect(self.path, timeout=60)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("PRAGMA mmap_size=%d" % MMAP_SIZE)
+            db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            db.execute("CREATE TABLE IF NOT EXISTS oids (hash TEXT PRIMARY KEY, oid INTEGER NOT NULL, used REAL NOT NULL)")
+            db.execute("CREATE INDEX IF NOT EXISTS oids_used_idx ON oids (used)")
+            db.commit()
+            self._db = db
+        return self._db
+
+    def clone(self):
+        # sqlite connections cannot be shared between threads
+        return OidCache(self.path, self.maxEntries)
+
+    def validate(self, source):
+        # drop all entries if they were taken from a different object table,
+        # e.g. after the database was recreated or the table truncated
+        row = self.db.execute("SELECT value FROM meta WHERE key='source'").fetchone()
+        if not row or row[0] != source:
+            with self.db:
+                self.db.execute("DELETE FROM oids")
+                self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('source', ?)", (source,))
+            return False
+        return True
+
+    def get(self, hashes):
+        result = dict()
+        hashes = list(hashes)
+        for i in range(0, len(hashes), QUERY_SIZE):
+            chunk = hashes[i:i + QUERY_SIZE]
+            query = "SELECT hash, oid FROM oids WHERE hash IN (%s)" % \
+                ",".join(["?"] * len(chunk))
+            result.update(self.db.execute(query, chunk).fetchall())
+
+        now = time.time()
+        with self.db:
+            self.db.executemany("UPDATE oids SET used=? WHERE hash=?",
+                                [(now, h) for h in result])
+
+        self.hits += len(result)
+        self.misses += len(hashes) - len(result)
+        return result
+
+    def put(self, mapping):
+        # mappings only become visible once commit() is called, so that oids
+        # from a rolled back transaction never end up in the cache
+        self.pending.update(mapping)
+
+    def rollback(self):
+        self.pending = dict()
+
+    def commit(self):
+        now = time.time()
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO oids (hash, oid, used) VALUES (?, ?, ?)",
+                                [(h, oid, now) for (h, oid) in self.pending.items()])
+            count = self.db.execute("SELECT COUNT(*) FROM oids").fetchone()[0]
+            if count > self.maxEntries:
+                self.db.execute("DELETE FROM oids WHERE hash IN (SELECT hash FROM oids ORDER BY used LIMIT ?)",
+                                (count - self.maxEntries,))
+        self.pending = dict()
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
@@ -20,6 +20,14 @@ IID=${1}
 
 WORK_DIR=`get_scratch ${IID}`
 IMAGE=`get_fs ${IID}`
+RUN_IMAGE=`get_run_fs ${IID} $$`
 KERNEL=`get_kernel "armel"`
+PORTS=(`get_free_ports 4`)
 
-QEMU_AUDIO_DRV=none qemu-system-arm -m 256 -M virt -kernel ${KERNEL} -drive if=none,file=${IMAGE},format=raw,id=rootfs -device virtio-blk-device,drive=rootfs -append "firmadyne.syscall=0 root=/dev/vda1 console=ttyS0 nandsim.parts=64,64,64,64,64,64,64,64,64,64 rdinit=/firmadyne/preInit.sh rw debug ignore_loglevel print-fatal-signals=1 user_debug=31" -nographic -device virtio-net-device,netdev=net1 -netdev socket,listen=:2000,id=net1 -device virtio-net-device,netdev=net2 -netdev socket,listen=:2001,id=net2 -device virtio-net-device,netdev=net3 -netdev socket,listen=:2002,id=net3 -device virtio-net-device,netdev=net4 -netdev socket,listen=:2003,id=net4
+# every run writes to its own overlay, so that runs of the same image neither
+# lock each other out nor see each other's writes
+qemu-img create -q -f qcow2 -F qcow2 -b `basename ${IMAGE}` ${RUN_IMAGE}
+trap 'rm -f ${RUN_IMAGE}' EXIT
+trap 'exit 1' INT TERM
+
+QEMU_AUDIO_DRV=none qemu-system-arm -m ${QEMU_MEMORY:-256} -M virt -kernel ${KERNEL} -drive if=none,file=${RUN_IMAGE},format=qcow2,id=rootfs -device virtio-blk-device,drive=rootfs -append "firmadyne.syscall=0 root=/dev/vda1 console=ttyS0 nandsim.parts=64,64,64,64,64,64,64,64,64,64 rdinit=/firmadyne/preInit.sh rw debug ignore_loglevel print-fatal-signals=1 user_debug=31" -nographic -device virtio-net-device,netdev=net1 -netdev socket,listen=:${PORTS[0]},id=net1 -device virtio-net-device,netdev=net2 -netdev socket,listen=:${PORTS[1]},id=net2 -device virtio-net-device,netdev=net3 -netdev socket,listen=:${PORTS[2]},id=net3 -device virtio-net-device,netdev=net4 -netdev socket,listen=:${PORTS[3]},id=net4
@@ -20,6 +20,14 @@ IID=${1}
 
 WORK_DIR=`get_scratch ${IID}`
 IMAGE=`get_fs ${IID}`
+RUN_IMAGE=`get_run_fs ${IID} $$`
 KERNEL=`get_kernel "mipseb"`
+PORTS=(`get_free_ports 4`)
 
-qemu-system-mips -m 256 -M malta -kernel ${KERNEL} -drive if=ide,format=raw,file=${IMAGE} -append "firmadyne.syscall=1 root=/dev/sda1 console=ttyS0 nandsim.parts=64,64,64,64,64,64,64,64,64,64 rdinit=/firmadyne/preInit.sh rw debug ignore_loglevel print-fatal-signals=1" -serial file:${WORK_DIR}/qemu.initial.serial.log -serial unix:/tmp/qemu.${IID}.S1,server,nowait -monitor unix:/tmp/qemu.${IID},server,nowait -display none -netdev socket,id=s0,listen=:2000 -device e1000,netdev=s0 -netdev socket,id=s1,listen=:2001 -device e1000,netdev=s1 -netdev socket,id=s2,listen=:2002 -device e1000,netdev=s2 -netdev socket,id=s3,listen=:2003 -device e1000,netdev=s3
+# every run writes to its own overlay, so that runs of the same image neither
+# lock each other out nor see each other's writes
+qemu-img create -q -f qcow2 -F qcow2 -b `basename ${IMAGE}` ${RUN_IMAGE}
+trap 'rm -f ${RUN_IMAGE}' EXIT
+trap 'exit 1' INT TERM
+
+qemu-system-mips -m ${QEMU_MEMORY:-256} -M malta -kernel ${KERNEL} -drive if=ide,format=qcow2,file=${RUN_IMAGE} -append "firmadyne.syscall=1 root=/dev/sda1 console=ttyS0 nandsim.parts=64,64,64,64,64,64,64,64,64,64 rdinit=/firmadyne/preInit.sh rw debug ignore_loglevel print-fatal-signals=1" -serial file:${WORK_DIR}/qemu.initial.serial.log -serial unix:/tmp/qemu.${IID}.S1,server,nowait -monitor unix:/tmp/qemu.${IID},server,nowait -display none -netdev socket,id=s0,listen=:${PORTS[0]} -device e1000,netdev=s0 -netdev socket,id=s1,listen=:${PORTS[1]} -device e1000,netdev=s1 -netdev socket,id=s2,listen=:${PORTS[2]} -device e1000,netdev=s2 -netdev socket,id=s3,listen=:${PORTS[3]} -device e1000,netdev=s3
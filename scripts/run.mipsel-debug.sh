@@ -20,6 +20,14 @@ IID=${1}
 
 WORK_DIR=`get_scratch ${IID}`
 IMAGE=`get_fs ${IID}`
+RUN_IMAGE=`get_run_fs ${IID} $$`
 KERNEL=`get_kernel "mipsel"`
+PORTS=(`get_free_ports 4`)
 
-qemu-system-mipsel -m 256 -M malta -kernel ${KERNEL} -drive if=ide,format=raw,file=${IMAGE} -append "firmadyne.syscall=0 root=/dev/sda1 console=ttyS0 nandsim.parts=64,64,64,64,64,64,64,64,64,64 rdinit=/firmadyne/preInit.sh rw debug ignore_loglevel print-fatal-signals=1" -nographic -net nic,vlan=0 -net socket,vlan=0,listen=:2000 -net nic,vlan=1 -net socket,vlan=1,listen=:2001 -net nic,vlan=2 -net socket,vlan=2,listen=:2002 -net nic,vlan=3 -net socket,vlan=3,listen=:2003
+# every run writes to its own overlay, so that runs of the same image neither
+# lock each other out nor see each other's writes
+qemu-img create -q -f qcow2 -F qcow2 -b `basename ${IMAGE}` ${RUN_IMAGE}
+trap 'rm -f ${RUN_IMAGE}' EXIT
+trap 'exit 1' INT TERM
+
+qemu-system-mipsel -m ${QEMU_MEMORY:-256} -M malta -kernel ${KERNEL} -drive if=ide,format=qcow2,file=${RUN_IMAGE} -append "firmadyne.syscall=0 root=/dev/sda1 console=ttyS0 nandsim.parts=64,64,64,64,64,64,64,64,64,64 rdinit=/firmadyne/preInit.sh rw debug ignore_loglevel print-fatal-signals=1" -nographic -net nic,vlan=0 -net socket,vlan=0,listen=:${PORTS[0]} -net nic,vlan=1 -net socket,vlan=1,listen=:${PORTS[1]} -net nic,vlan=2 -net socket,vlan=2,listen=:${PORTS[2]} -net nic,vlan=3 -net socket,vlan=3,listen=:${PORTS[3]}
@@ -27,8 +27,7 @@ if [ $# -gt 1 ]; then
     ARCH=${2}
 else
     echo -n "Querying database for architecture... "
-    ARCH=$(psql -d firmware -U firmadyne -h 127.0.0.1 -t -q -c "SELECT arch from image WHERE id=${1};")
-    ARCH="${ARCH#"${ARCH%%[![:space:]]*}"}"
+    ARCH=$("${SCRIPT_DIR}/firmadb.py" get-arch "${1}" || true)
     echo "${ARCH}"
     if [ -z "${ARCH}" ]; then
         echo "Error: Unable to lookup architecture. Please specify {armel,mipseb,mipsel} as the second argument!"
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+import getopt
+import hashlib
+import random
+import struct
+import sys
+import time
+
+import firmadb
+
+# MinHash signature length, split into BANDS bands of ROWS rows each for
+# locality-sensitive hashing; two images with Jaccard similarity s share at
+# least one band with probability 1 - (1 - s^ROWS)^BANDS
+NUM_PERM = 128
+BANDS = 32
+ROWS = NUM_PERM // BANDS
+
+# 2^61 - 1, so that all hash values fit into a signed 64-bit integer
+PRIME = (1 << 61) - 1
+SEED = 1
+
+def getPermutations(n=NUM_PERM, seed=SEED):
+    rng = random.Random(seed)
+    return [(rng.randrange(1, PRIME), rng.randrange(0, PRIME)) for i in range(n)]
+
+PERMUTATIONS = getPermutations()
+
+def minhash(oids):
+    oids = list(oids)
+    if not oids:
+        return None
+    return [min([(a * x + b) % PRIME for x in oids]) for (a, b) in PERMUTATIONS]
+
+def bands(signature):
+    # reduce each band to a single signed 64-bit bucket id
+    result = []
+    for i in range(BANDS):
+        band = signature[i * ROWS:(i + 1) * ROWS]
+        digest = hashlib.md5(struct.pack(">%dq" % ROWS, *band)).digest()
+        result.append((i, struct.unpack(">q", digest[:8])[0]))
+    return result
+
+def similarity(sig1, sig2):
+    return sum([1 for (x, y) in zip(sig1, sig2) if x == y]) / float(NUM_PERM)
+
+def encodeSignature(cur, signature):
+    # sqlite has no array type, so signatures are stored as text there
+    if firmadb.backend(cur) == "sqlite":
+        return ",".join([str(x) for x in signature])
+    return signature
+
+def decodeSignature(cur, value):
+    if isinstance(value, str):
+        return [int(x) for x in value.split(",")]
+    return value
+
+def getImageOids(cur, iid):
+    # symbolic links all point to a placeholder object, so ignore them
+    cur.execute("SELECT DISTINCT oid FROM object_to_image WHERE iid=%s AND regular_file", (iid,))
+    return [x[0] for x in cur.fetchall()]
+
+def updateImage(cur, iid):
+    oids = getImageOids(cur, iid)
+    signature = minhash(oids)
+
+    cur.execute("DELETE FROM image_lsh WHERE iid=%s", (iid,))
+    cur.execute("DELETE FROM image_minhash WHERE iid=%s", (iid,))
+    if not signature:
+        return None
+
+    cur.execute("INSERT INTO image_minhash (iid, signature, size) VALUES (%s, %s, %s)",
+                (iid, encodeSignature(cur, signature), len(oids)))
+    cur.executemany("INSERT INTO image_lsh (band, bucket, iid) VALUES (%s, %s, %s)",
+                    [(band, bucket, iid) for (band, bucket) in bands(signature)])
+    return signature
+
+def getSignature(cur, iid):
+    cur.execute("SELECT signature FROM image_minhash WHERE iid=%s", (iid,))
+    row = cur.fetchone()
+    return decodeSignature(cur, row[0]) if row else None
+
+def findSimilar(cur, iid, k=10, signature=None):
+    # returns up to k (iid, estimated Jaccard similarity) pairs, most similar
+    # first, considering only images that share at least one LSH band
+    if signature is None:
+        signature = getSignature(cur, iid)
+    if signature is None:
+        signature = minhash(getImageOids(cur, iid))
+    if signature is None:
+        return []
+
+    buckets = bands(signature)
+    query = """SELECT m.iid, m.signature FROM image_minhash m WHERE m.iid IN (SELECT DISTINCT iid FROM image_lsh WHERE (band, bucket) IN (VALUES %s)) AND m.iid <> %%s""" % \
+        ", ".join(["(%s, %s)"] * len(buckets))
+    cur.execute(query, [x for b in buckets for x in b] + [iid])
+    result = [(other, similarity(signature, decodeSignature(cur, sig))) \
+              for (other, sig) in cur.fetchall()]
+    result.sort(key=lambda x: (-x[1], x[0]))
+    return result[:k]
+
+def rebuild(cur):
+    cur.execute("SELECT DISTINCT iid FROM object_to_image ORDER BY iid")
+    iids = [x[0] for x in cur.fetchall()]
+    for iid in iids:
+        updateImage(cur, iid)
+    return len(iids)
+
+def main():
+    iid = None
+    top = 10
+    build = update = False
+    host = None
+    opts, argv = getopt.getopt(sys.argv[1:], "i:k:bus:")
+    for k, v in opts:
+        if k == '-i':
+            iid = int(v)
+        if k == '-k':
+            top = int(v)
+        if k == '-b':
+            build = True
+        if k == '-u':
+            update = True
+        if k == '-s':
+            host = v
+
+    if not build and iid is None:
+        print("Usage: simindex.py [-s <sql host>] -b | -i <image ID> [-u] [-k <count>]")
+        sys.exit(1)
+
+    dbh = firmadb.connect(host)
+    cur = dbh.cursor()
+
+    if build:
+        start = time.time()
+        count = rebuild(cur)
+        dbh.commit()
+        print("Indexed %d images in %.3f s" % (count, time.time() - start))
+
+    if iid is not None:
+        if update:
+            updateImage(cur, iid)
+            dbh.commit()
+        start = time.time()
+        result = findSimilar(cur, iid, top)
+        for (other, sim) in result:
+            print("%d\t%.3f" % (other, sim))
+        print("Found %d similar images in %.3f s" % (len(result), time.time() - start))
+
+    dbh.close()
+
+if __name__ == "__main__":
+    main()
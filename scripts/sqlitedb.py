@@ -0,0 +1,79 @@
+import os
+import re
+import sqlite3
+
+SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                      "database", "schema.sqlite")
+
+def convertQuery(query):
+    # translate the pyformat parameters used with psycopg2 to sqlite's
+    query = re.sub(r"%\((\w+)\)s", r":\1", query)
+    return query.replace("%s", "?").replace("%%", "%")
+
+class Cursor(object):
+    # minimal psycopg2-compatible cursor on top of sqlite3
+    backend = "sqlite"
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.cur = connection.dbh.cursor()
+
+    @property
+    def rowcount(self):
+        return self.cur.rowcount
+
+    def execute(self, query, args=None):
+        self.cur.execute(convertQuery(query), args if args is not None else ())
+
+    def executemany(self, query, args):
+        self.cur.executemany(convertQuery(query), args)
+
+    def fetchone(self):
+        return self.cur.fetchone()
+
+    def fetchall(self):
+        return self.cur.fetchall()
+
+    def __iter__(self):
+        return iter(self.cur)
+
+    def close(self):
+        self.cur.close()
+
+class Connection(object):
+    # in-process replacement for a psycopg2 connection, storing the schema in
+    # database/schema.sqlite in a single file in WAL mode
+    backend = "sqlite"
+
+    def __init__(self, path):
+        self.path = path
+        self.dbh = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.dbh.execute("PRAGMA journal_mode=WAL")
+        self.dbh.execute("PRAGMA synchronous=NORMAL")
+        # sqlite only honours the ON DELETE CASCADE clauses of the schema
+        # with foreign keys enabled, which is a per-connection setting
+        self.dbh.execute("PRAGMA foreign_keys=ON")
+        with open(SCHEMA) as f:
+            self.dbh.executescript(f.read())
+
+    def cursor(self, name=None):
+        # sqlite cursors already step through results lazily, so there is no
+        # need for separate server-side cursors
+        return Cursor(self)
+
+    def commit(self):
+        self.dbh.commit()
+
+    def rollback(self):
+        self.dbh.rollback()
+
+    def close(self):
+        self.dbh.close()
+
+def getTableId(cur, table):
+    # changes if the database file is replaced or the table is recreated
+    cur.execute("SELECT rootpage FROM sqlite_master WHERE type='table' AND name=%s", (table,))
+    row = cur.fetchone()
+    st = os.stat(cur.connection.path)
+    return "sqlite:%s:%d:%d:%s" % (os.path.realpath(cur.connection.path),
+                                   st.st_dev, st.st_ino, row[0] if row else None)
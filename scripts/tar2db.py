@@ -3,54 +3,285 @@
 import tarfile
 import getopt
 import sys
-import re
+import os
 import hashlib
-import psycopg2
-import six
+import concurrent.futures
+import functools
+import itertools
+import multiprocessing
+import queue
+import threading
+import time
 
-def getFileHashes(infile):
-    t = tarfile.open(infile)
+# psycopg2 is only required for the postgres backend
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+import firmadb
+import getArch
+import oidcache
+import simindex
+import sqlitedb
+import webroot
+
+# size of the reads used to hash tar members, and number of records handed to
+# the database at once in streaming mode
+CHUNK_SIZE = 64 * 1024
+BATCH_SIZE = 1000
+
+# members larger than this are hashed by the decompression thread instead of
+# being buffered for the hashing threads
+MAX_BUFFER = 4 * 1024 * 1024
+
+# number of database connections used to store images in batch mode
+WRITERS = 2
+
+# maximum number of hashes bound to a single query with the sqlite backend
+SQLITE_QUERY_SIZE = 500
+
+def hashChunks(chunks, blake2b=False):
+    md5 = hashlib.md5()
+    b2 = hashlib.blake2b() if blake2b else None
+    for buf in chunks:
+        md5.update(buf)
+        if b2:
+            b2.update(buf)
+    return (md5.hexdigest(), b2.hexdigest() if b2 else None)
+
+def iterChunks(fp, chunk=CHUNK_SIZE):
+    return iter(lambda: fp.read(chunk), b"")
+
+def fileRecord(f, digests):
+    # we use f.name[1:] to get rid of the . at the beginning of the path
+    return (f.name[1:], digests[0], f.uid, f.gid, f.mode, digests[1])
+
+class ImageStats(object):
+    # architecture, uncompressed size and number of inodes of the root
+    # filesystem, gathered in the same pass over the tarball as the hashes
+    def __init__(self):
+        self.detector = getArch.ArchDetector()
+        self.size = 0
+        self.inodes = 0
+
+    def add(self, f, header=None):
+        self.inodes += 1
+        if header is not None and self.detector.wants(f.name):
+            self.detector.add(f.name, header)
+
+    def finish(self, t):
+        # bytes read from the uncompressed tarball, as with tar --totals
+        self.size = t.offset
+
+    @property
+    def arch(self):
+        return self.detector.result()[1]
+
+def iterFileHashes(infile, threads=0, blake2b=False, stats=None):
+    if threads:
+        yield from iterFileHashesThreaded(infile, threads, blake2b, stats)
+        return
+
+    # read the tarball sequentially, so that only one chunk of one member is
+    # held in memory at a time
+    with tarfile.open(infile, "r|*") as t:
+        for f in t:
+            if f.isfile():
+                chunks = iterChunks(t.extractfile(f))
+                first = next(chunks, b"")
+                if stats:
+                    stats.add(f, first)
+                yield ("file", fileRecord(f, hashChunks(
+                    itertools.chain([first], chunks), blake2b)))
+            else:
+                if stats:
+                    stats.add(f)
+                if f.issym():
+                    yield ("link", (f.name[1:], f.linkpath))
+            # tarfile remembers every member, even in stream mode
+            t.members = []
+        if stats:
+            stats.finish(t)
+
+def iterFileHashesThreaded(infile, threads, blake2b=False, stats=None):
+    # one thread decompresses the tarball and queues the contents of each
+    # member, while a pool of threads hashes them; the queue holds futures in
+    # tar order, so that records are still yielded in the same order
+    q = queue.Queue(maxsize=threads * 2)
+    pool = concurrent.futures.ThreadPoolExecutor(threads)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def decompress():
+        try:
+            with tarfile.open(infile, "r|*") as t:
+                for f in t:
+                    if f.isfile():
+                        chunks = iterChunks(t.extractfile(f))
+                        if f.size > MAX_BUFFER:
+                            # too large to buffer, hash while decompressing
+                            first = next(chunks, b"")
+                            if stats:
+                                stats.add(f, first)
+                            item = ("file", f, hashChunks(
+                                itertools.chain([first], chunks), blake2b))
+                        else:
+                            chunks = list(chunks)
+                            if stats:
+                                stats.add(f, chunks[0] if chunks else b"")
+                            item = ("file", f, pool.submit(hashChunks, chunks,
+                                                           blake2b))
+                    else:
+                        if stats:
+                            stats.add(f)
+                        item = ("link", f, None) if f.issym() else None
+                    if item and not put(item):
+                        return
+                    t.members = []
+                if stats:
+                    stats.finish(t)
+            put(None)
+        except Exception as e:
+            put(e)
+
+    thread = threading.Thread(target=decompress)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item = q.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            (kind, f, digests) = item
+            if kind == "file":
+                if not isinstance(digests, tuple):
+                    digests = digests.result()
+                yield ("file", fileRecord(f, digests))
+            else:
+                yield ("link", (f.name[1:], f.linkpath))
+    finally:
+        stop.set()
+        thread.join()
+        pool.shutdown()
+
+def getFileHashes(infile, threads=0, blake2b=False, stats=None):
     files = list()
     links = list()
-    for f in t.getmembers():
-        if f.isfile():
-            # we use f.name[1:] to get rid of the . at the beginning of the path
-            files.append((f.name[1:], hashlib.md5(t.extractfile(f).read()).hexdigest(),
-                          f.uid, f.gid, f.mode))
-        elif f.issym():
-            links.append((f.name[1:], f.linkpath))
+    for (kind, rec) in iterFileHashes(infile, threads, blake2b, stats):
+        if kind == "file":
+            files.append(rec)
+        else:
+            links.append(rec)
     return (files, links)
 
-def getOids(objs, cur):
+def iterBatches(records, size=BATCH_SIZE):
+    files = list()
+    links = list()
+    for (kind, rec) in records:
+        if kind == "file":
+            files.append(rec)
+        else:
+            links.append(rec)
+        if len(files) + len(links) >= size:
+            yield (files, links)
+            files = list()
+            links = list()
+    if files or links:
+        yield (files, links)
+
+def getOids(objs, cur, cache=None):
     # hashes ... all the hashes in the tar file
-    hashes = [x[1] for x in objs]
-    hashes_str = ",".join(["""'%s'""" % x for x in hashes])
-    query = """SELECT id,hash FROM object WHERE hash IN (%s)"""
-    cur.execute(query % hashes_str)
-    res = [(int(x), y) for (x, y) in cur.fetchall()]
+    hashes = sorted(set([x[1] for x in objs]))
+    extra = dict([(x[1], x[5]) for x in objs if x[5]])
+    result = dict()
+    if cache:
+        result = cache.get(hashes)
+        hashes = [h for h in hashes if h not in result]
+        # objects served from the cache skip createObjects, so fill in their
+        # missing BLAKE2b digests here
+        fillObjects(dict([(result[h], extra[h]) for h in result if h in extra]), cur)
+    if not hashes:
+        return result
+
+    createObjects(hashes, cur, extra)
 
-    existingHashes = [x[1] for x in res]
+    found = lookupObjects(hashes, cur)
+    if cache:
+        cache.put(found)
+    result.update(found)
+    return result
 
-    missingHashes = set(hashes).difference(set(existingHashes))
+def lookupObjects(hashes, cur):
+    if firmadb.backend(cur) == "sqlite":
+        result = dict()
+        for i in range(0, len(hashes), SQLITE_QUERY_SIZE):
+            chunk = hashes[i:i + SQLITE_QUERY_SIZE]
+            query = """SELECT id, hash FROM object WHERE hash IN (%s)""" % \
+                ",".join(["%s"] * len(chunk))
+            cur.execute(query, chunk)
+            result.update([(y, int(x)) for (x, y) in cur.fetchall()])
+        return result
 
-    newObjs = createObjects(missingHashes, cur)
+    # a separate statement, so that hashes inserted by a concurrent ingest
+    # that committed in the meantime are visible as well
+    query = """SELECT o.id, o.hash FROM object o JOIN unnest(%(hashes)s::character varying[]) AS h(hash) ON o.hash = h.hash"""
+    cur.execute(query, {'hashes': hashes})
+    return dict([(y, int(x)) for (x, y) in cur.fetchall()])
 
-    res += newObjs
+def getObjectTableId(cur):
+    # identifies the current contents of the object table; this changes if
+    # the database or table is recreated, or the table is truncated
+    if firmadb.backend(cur) == "sqlite":
+        return sqlitedb.getTableId(cur, "object")
+    cur.execute("""SELECT current_database(), inet_server_addr(), inet_server_port(), 'object'::regclass::oid, pg_relation_filenode('object')""")
+    return ":".join([str(x) for x in cur.fetchone()])
 
-    result = dict([(y, x) for (x, y) in res])
-    return result
+def createObjects(hashes, cur, extra=None):
+    # inserting in sorted order keeps concurrent ingests that share new hashes
+    # from deadlocking on object_hash_key
+    hashes = sorted(set(hashes))
+    if firmadb.backend(cur) == "sqlite":
+        # sqlite has no arrays, but only allows a single writer anyway
+        query = """INSERT INTO object (hash, blake2b) VALUES (%s, %s) ON CONFLICT (hash) DO UPDATE SET blake2b = excluded.blake2b WHERE object.blake2b IS NULL AND excluded.blake2b IS NOT NULL"""
+        cur.executemany(query, [(h, extra.get(h) if extra else None) \
+                                for h in hashes])
+        return []
+    if extra:
+        # also record the BLAKE2b digest, filling it in for existing objects
+        # that were loaded without one
+        query = """INSERT INTO object (hash, blake2b) SELECT h, b FROM unnest(%(hashes)s::character varying[], %(extra)s::character varying[]) AS t(h, b) ORDER BY h ON CONFLICT (hash) DO UPDATE SET blake2b = EXCLUDED.blake2b WHERE object.blake2b IS NULL RETURNING id, hash"""
+        cur.execute(query, {'hashes': hashes,
+                            'extra': [extra.get(h) for h in hashes]})
+    else:
+        query = """INSERT INTO object (hash) SELECT h FROM unnest(%(hashes)s::character varying[]) AS h ORDER BY h ON CONFLICT (hash) DO NOTHING RETURNING id, hash"""
+        cur.execute(query, {'hashes': hashes})
+    return [(int(x), y) for (x, y) in cur.fetchall()]
 
-def createObjects(hashes, cur):
-    query = """INSERT INTO object (hash) VALUES (%(hash)s) RETURNING id"""
-    res = list()
-    for h in set(hashes):
-        cur.execute(query, {'hash':h})
-        oid = int(cur.fetchone()[0])
-        res.append((oid, h))
-    return res
+def fillObjects(digests, cur):
+    # digests ... oid -> BLAKE2b digest, only set for objects without one
+    if not digests:
+        return
+    oids = sorted(digests)
+    if firmadb.backend(cur) == "sqlite":
+        cur.executemany("""UPDATE object SET blake2b=%s WHERE id=%s AND blake2b IS NULL""",
+                        [(digests[x], x) for x in oids])
+        return
+    query = """UPDATE object SET blake2b = t.b FROM unnest(%(oids)s::integer[], %(digests)s::character varying[]) AS t(id, b) WHERE object.id = t.id AND object.blake2b IS NULL"""
+    cur.execute(query, {'oids': oids, 'digests': [digests[x] for x in oids]})
 
 def insertObjectToImage(iid, files2oids, links, cur):
-    query = """INSERT INTO object_to_image (iid, oid, filename, regular_file, uid, gid, permissions) VALUES (%(iid)s, %(oid)s, %(filename)s, %(regular_file)s, %(uid)s, %(gid)s, %(mode)s)"""
+    query = """INSERT INTO object_to_image (iid, oid, filename, regular_file, uid, gid, permissions) VALUES (%(iid)s, %(oid)s, %(filename)s, %(regular_file)s, %(uid)s, %(gid)s, %(mode)s) ON CONFLICT (oid, iid, filename) DO NOTHING"""
 
     cur.executemany(query, [{'iid': iid, 'oid' : x[1], 'filename' : x[0][0],
                              'regular_file' : True, 'uid' : x[0][1],
@@ -61,41 +292,288 @@ def insertObjectToImage(iid, files2oids, links, cur):
                              'gid' : None, 'mode' : None} \
                             for x in links])
 
-def process(iid, infile):
-    dbh = psycopg2.connect(database="firmware", user="firmadyne",
-                           password="firmadyne", host="127.0.0.1")
+def copyEscape(value):
+    if value is None:
+        return "\\N"
+    if value is True or value is False:
+        return "t" if value else "f"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t") \
+            .replace("\n", "\\n").replace("\r", "\\r")
+
+class CopyReader(object):
+    # file-like wrapper that renders rows in COPY text format on demand, so
+    # that the rows are never materialized as one large buffer
+    def __init__(self, rows):
+        self.lines = ("\t".join([copyEscape(x) for x in r]) + "\n" \
+                for r in rows)
+        self.buf = ""
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buf) < size:
+            try:
+                self.buf += next(self.lines)
+            except StopIteration:
+                break
+        if size < 0:
+            (data, self.buf) = (self.buf, "")
+        else:
+            (data, self.buf) = (self.buf[:size], self.buf[size:])
+        return data
+
+def copyObjectToImage(iid, files2oids, links, cur):
+    def rows():
+        for ((filename, uid, gid, mode), oid) in files2oids:
+            yield (oid, iid, filename, True, mode, uid, gid)
+        for x in links:
+            yield (1, iid, x[0], False, None, None, None)
+
+    # load into a staging table first, so that rows which already exist do not
+    # violate object_to_image_oid_iid_filename_key
+    cur.execute("""CREATE TEMPORARY TABLE IF NOT EXISTS object_to_image_stage (oid integer, iid integer, filename character varying, regular_file boolean, permissions integer, uid integer, gid integer) ON COMMIT DROP""")
+    cur.copy_expert("""COPY object_to_image_stage (oid, iid, filename, regular_file, permissions, uid, gid) FROM STDIN""",
+                    CopyReader(rows()))
+    cur.execute("""INSERT INTO object_to_image (oid, iid, filename, regular_file, permissions, uid, gid) SELECT oid, iid, filename, regular_file, permissions, uid, gid FROM object_to_image_stage ON CONFLICT (oid, iid, filename) DO NOTHING""")
+    cur.execute("""TRUNCATE object_to_image_stage""")
+
+def loadObjectToImage(iid, files2oids, links, cur, copy=False):
+    # returns the method that was used
+    method = "executemany"
+    if copy and firmadb.backend(cur) == "postgres":
+        method = "copy"
+        cur.execute("SAVEPOINT object_to_image_copy")
+        try:
+            copyObjectToImage(iid, files2oids, links, cur)
+            cur.execute("RELEASE SAVEPOINT object_to_image_copy")
+        except (AttributeError, psycopg2.NotSupportedError,
+                psycopg2.ProgrammingError) as e:
+            print("Warning: COPY unavailable, falling back to INSERT: %s" % e)
+            cur.execute("ROLLBACK TO SAVEPOINT object_to_image_copy")
+            method = "executemany"
+    if method == "executemany":
+        insertObjectToImage(iid, files2oids, links, cur)
+    return method
+
+def reportObjectToImage(iid, rows, methods, elapsed):
+    print("object_to_image: %d rows for image %d via %s in %.3f s" % \
+            (rows, iid, "/".join(sorted(set(methods))) or "executemany", elapsed))
+
+def fileOids(files, oids):
+    # every path is recorded, including files that share their contents
+    return [((filename, uid, gid, mode), oids[h]) \
+            for (filename, h, uid, gid, mode, b2) in files]
+
+def processStream(iid, infile, cur, copy=False, cache=None, threads=0,
+                  blake2b=False, stats=None):
+    # hash and insert the tarball batch by batch
+    rows = 0
+    methods = []
+    elapsed = 0
+    for (files, links) in iterBatches(iterFileHashes(infile, threads, blake2b,
+                                                     stats)):
+        file2oid = fileOids(files, getOids(files, cur, cache))
+
+        start = time.time()
+        methods.append(loadObjectToImage(iid, file2oid, links, cur, copy))
+        elapsed += time.time() - start
+        rows += len(file2oid) + len(links)
+    reportObjectToImage(iid, rows, methods, elapsed)
+
+def storeImage(iid, files, links, cur, copy=False, cache=None):
+    file2oid = fileOids(files, getOids(files, cur, cache))
+
+    start = time.time()
+    method = loadObjectToImage(iid, file2oid, links, cur, copy)
+    reportObjectToImage(iid, len(file2oid) + len(links), [method],
+                        time.time() - start)
+
+def storeImageInfo(iid, stats, cur):
+    # later stages read these instead of decompressing the tarball again
+    firmadb.setImageInfo(cur, iid, stats.arch, stats.size, stats.inodes)
+    print("image %d: arch %s, %d bytes, %d inodes" % \
+            (iid, stats.arch, stats.size, stats.inodes))
+
+def process(iid, infile, stream=False, copy=False, cache=None, threads=0,
+            blake2b=False, minhash=False, info=False):
+    dbh = firmadb.connect()
     cur = dbh.cursor()
 
-    (files, links) = getFileHashes(infile)
+    if cache:
+        cache.validate(getObjectTableId(cur))
 
-    oids = getOids(files, cur)
+    stats = ImageStats() if info else None
+    if stream:
+        processStream(iid, infile, cur, copy, cache, threads, blake2b, stats)
+    else:
+        (files, links) = getFileHashes(infile, threads, blake2b, stats)
+        storeImage(iid, files, links, cur, copy, cache)
 
-    fdict = dict([(h, (filename, uid, gid, mode)) \
-            for (filename, h, uid, gid, mode) in files])
+    if stats:
+        storeImageInfo(iid, stats, cur)
 
-    file2oid = [(fdict[h], oid) for (h, oid) in six.iteritems(oids)]
+    # files served by the web server, for the analyses
+    webroot.updateImage(cur, iid)
 
-    insertObjectToImage(iid, file2oid, links, cur)
+    if minhash:
+        simindex.updateImage(cur, iid)
 
     dbh.commit()
 
+    if cache:
+        cache.commit()
+        print("oid cache: %d hits, %d misses" % (cache.hits, cache.misses))
+
     dbh.close()
 
+def hashImage(infile, threads=0, blake2b=False, info=False):
+    # runs in a worker process; exceptions are returned rather than raised so
+    # that a single broken tarball does not abort the whole batch
+    try:
+        stats = ImageStats() if info else None
+        (files, links) = getFileHashes(infile, threads, blake2b, stats)
+        return (infile, (files, links, stats), None)
+    except Exception as e:
+        return (infile, None, "%s: %s" % (type(e).__name__, e))
+
+def writeImages(q, results, copy=False, cache=None, minhash=False):
+    # each writer keeps a connection from the shared pool for the whole batch
+    with firmadb.pooled() as dbh:
+        writeImagesTo(dbh, q, results, copy, cache, minhash)
+
+def writeImagesTo(dbh, q, results, copy=False, cache=None, minhash=False):
+    cur = dbh.cursor()
+    if cache:
+        cache = cache.clone()
+        cache.validate(getObjectTableId(cur))
+    while True:
+        item = q.get()
+        if item is None:
+            break
+        (iid, infile, files, links, stats) = item
+        try:
+            storeImage(iid, files, links, cur, copy, cache)
+            if stats:
+                storeImageInfo(iid, stats, cur)
+            webroot.updateImage(cur, iid)
+            if minhash:
+                simindex.updateImage(cur, iid)
+            dbh.commit()
+            if cache:
+                cache.commit()
+            results[infile] = None
+        except Exception as e:
+            dbh.rollback()
+            if cache:
+                cache.rollback()
+            results[infile] = "%s: %s" % (type(e).__name__, e)
+    if cache:
+        cache.close()
+
+def processDir(indir, jobs=None, writers=WRITERS, copy=False, cache=None,
+               threads=0, blake2b=False, minhash=False, info=False):
+    tarballs = sorted([os.path.join(indir, x) for x in os.listdir(indir) \
+            if getArch.getIid(x) is not None])
+    results = dict()
+
+    # sqlite only supports a single writer at a time
+    if firmadb.backend() == "sqlite":
+        writers = 1
+
+    # start the worker processes before any threads or connections exist
+    pool = multiprocessing.Pool(jobs)
+
+    # hashed images are handed to a few writer threads, each of which borrows
+    # a single database connection
+    if firmadb.backend() != "sqlite":
+        firmadb.getPool(max(writers, firmadb.POOL_SIZE))
+    q = queue.Queue(maxsize=writers * 2)
+    workers = [threading.Thread(target=writeImages,
+                                args=(q, results, copy, cache, minhash)) \
+            for i in range(writers)]
+    for t in workers:
+        t.start()
+
+    try:
+        for (infile, hashes, error) in pool.imap_unordered(
+                functools.partial(hashImage, threads=threads, blake2b=blake2b,
+                                  info=info),
+                tarballs):
+            if error:
+                results[infile] = error
+                continue
+            (files, links, stats) = hashes
+            q.put((getArch.getIid(infile), infile, files, links, stats))
+    finally:
+        pool.close()
+        pool.join()
+        for t in workers:
+            q.put(None)
+        for t in workers:
+            t.join()
+        firmadb.closePool()
+
+    failed = 0
+    for infile in tarballs:
+        error = results.get(infile, "not processed")
+        if error:
+            failed += 1
+            print("FAIL %s: %s" % (infile, error))
+        else:
+            print("OK   %s" % infile)
+    print("Processed %d images, %d failed" % (len(tarballs), failed))
+    return failed == 0
+
 def main():
-    infile = iid = None
-    opts, argv = getopt.getopt(sys.argv[1:], "f:i:")
+    infile = iid = indir = jobs = cache = None
+    stream = copy = blake2b = minhash = info = False
+    threads = 0
+    writers = WRITERS
+    cacheSize = oidcache.MAX_ENTRIES
+    opts, argv = getopt.getopt(sys.argv[1:], "f:i:sca",
+                               ["dir=", "jobs=", "writers=", "cache=",
+                                "cache-size=", "threads=", "blake2b",
+                                "minhash"])
     for k, v in opts:
         if k == '-i':
             iid = int(v)
         if k == '-f':
             infile = v
+        if k == '-s':
+            stream = True
+        if k == '-c':
+            copy = True
+        if k == '-a':
+            info = True
+        if k == '--dir':
+            indir = v
+        if k == '--jobs':
+            jobs = int(v)
+        if k == '--writers':
+            writers = int(v)
+        if k == '--cache':
+            cache = v
+        if k == '--cache-size':
+            cacheSize = int(v)
+        if k == '--threads':
+            threads = int(v)
+        if k == '--blake2b':
+            blake2b = True
+        if k == '--minhash':
+            minhash = True
+
+    if cache:
+        cache = oidcache.OidCache(cache, cacheSize)
+
+    if indir:
+        if not processDir(indir, jobs, writers, copy, cache, threads,
+                          blake2b, minhash, info):
+            sys.exit(1)
+        return
 
     if infile and not iid:
-        m = re.search(r"(\d+)\.tar\.gz", infile)
-        if m:
-            iid = int(m.group(1))
+        iid = getArch.getIid(infile)
 
-    process(iid, infile)
+    process(iid, infile, stream, copy, cache, threads, blake2b, minhash,
+            info)
 
 if __name__ == "__main__":
     main()
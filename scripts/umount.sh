@@ -28,12 +28,12 @@ WORK_DIR=`get_scratch ${IID}`
 IMAGE=`get_fs ${IID}`
 IMAGE_DIR=`get_fs_mount ${IID}`
 
-DEVICE=$(get_device "$(kpartx -u -s -v "${IMAGE}")")
+NBD=$(cat "${WORK_DIR}/nbd")
+DEVICE="${NBD}p1"
 
 echo "----Unmounting ${IMAGE_DIR}----"
 umount "${DEVICE}"
 
 echo "----Disconnecting Device File ${DEVICE}----"
-kpartx -d "${IMAGE}"
-losetup -d "${DEVICE}" &>/dev/null
-dmsetup remove $(basename "${DEVICE}") &>/dev/null
+qemu-nbd --disconnect "${NBD}"
+rm "${WORK_DIR}/nbd"
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+import getopt
+import os
+import sys
+import time
+
+import firmadb
+
+# directories that are commonly the document root of the web server
+ROOT_NAMES = set(["www", "web", "webs", "htdocs", "html", "webroot", "wwwroot",
+                  "web_root", "httpd"])
+
+# names of files that mark a directory as a document root
+INDEX_NAMES = set(["index.htm", "index.html", "index.asp", "index.php",
+                   "index.cgi", "index.shtml", "home.htm", "home.asp",
+                   "login.htm", "login.html", "login.asp"])
+
+# classes of files by extension, in the order in which they are probed; pages
+# that are generated on the server are the most likely to be reachable
+# without authentication
+CLASSES = [
+    ("script", [".cgi", ".php", ".asp", ".aspx", ".jsp", ".lua"]),
+    ("page", [".htm", ".html", ".shtml", ".rg"]),
+    ("data", [".bin", ".xml"]),
+    ("none", [""]),
+]
+STATIC = "static"
+
+RANKS = dict([(name, i) for (i, (name, exts)) in enumerate(CLASSES)] + \
+             [(STATIC, len(CLASSES))])
+EXTENSIONS = dict([(ext, name) for (name, exts) in CLASSES for ext in exts])
+
+def classify(path):
+    ext = os.path.splitext(os.path.basename(path))[1].lower()
+    return EXTENSIONS.get(ext, STATIC)
+
+def candidateRoots(filename):
+    # every directory on the path that has a document root name, outermost
+    # first
+    parts = filename.split("/")
+    return ["/".join(parts[:i + 1]) for i in range(len(parts) - 1) \
+            if parts[i] in ROOT_NAMES]
+
+def findRoots(filenames):
+    # directories that contain an index page
+    return set([os.path.dirname(x) for x in filenames \
+                if os.path.basename(x).lower() in INDEX_NAMES])
+
+def buildManifest(filenames):
+    # returns (filename, root, path, kind, rank) for every file below a
+    # document root; a file below several candidate roots is served from the
+    # innermost one with an index page, or the outermost one otherwise
+    indexed = findRoots(filenames)
+    result = []
+    for filename in sorted(set(filenames)):
+        roots = candidateRoots(filename)
+        if not roots:
+            continue
+        marked = [x for x in roots if x in indexed]
+        root = marked[-1] if marked else roots[0]
+        path = filename[len(root):]
+        if not path.strip("/"):
+            continue
+        kind = classify(path)
+        result.append((filename, root, path, kind, RANKS[kind]))
+    return result
+
+def updateImage(cur, iid):
+    # symbolic links are included, since web servers follow them
+    cur.execute("SELECT filename FROM object_to_image WHERE iid=%s", (iid,))
+    manifest = buildManifest([x[0] for x in cur.fetchall()])
+
+    cur.execute("DELETE FROM web_file WHERE iid=%s", (iid,))
+    cur.executemany("INSERT INTO web_file (iid, filename, root, path, kind, rank) VALUES (%s, %s, %s, %s, %s, %s)",
+                    [(iid,) + x for x in manifest])
+    return manifest
+
+def getFiles(cur, iid, static=False):
+    # URL paths served by an image, most promising first
+    limit = RANKS[STATIC] + 1 if static else RANKS[STATIC]
+    cur.execute("SELECT path FROM web_file WHERE iid=%s AND rank < %s ORDER BY rank, path",
+                (iid, limit))
+    return [x[0] for x in cur.fetchall()]
+
+def rebuild(cur):
+    cur.execute("SELECT DISTINCT iid FROM object_to_image ORDER BY iid")
+    iids = [x[0] for x in cur.fetchall()]
+    for iid in iids:
+        updateImage(cur, iid)
+    return len(iids)
+
+def main():
+    iid = None
+    build = update = static = False
+    host = None
+    opts, argv = getopt.getopt(sys.argv[1:], "i:buas:")
+    for k, v in opts:
+        if k == '-i':
+            iid = int(v)
+        if k == '-b':
+            build = True
+        if k == '-u':
+            update = True
+        if k == '-a':
+            static = True
+        if k == '-s':
+            host = v
+
+    if not build and iid is None:
+        print("Usage: webroot.py [-s <sql host>] -b | -i <image ID> [-u] [-a]")
+        sys.exit(1)
+
+    dbh = firmadb.connect(host)
+    cur = dbh.cursor()
+
+    if build:
+        start = time.time()
+        count = rebuild(cur)
+        dbh.commit()
+        print("Classified web files of %d images in %.3f s" % (count, time.time() - start))
+
+    if iid is not None:
+        if update:
+            updateImage(cur, iid)
+            dbh.commit()
+        for path in getFiles(cur, iid, static):
+            print(path)
+
+    dbh.close()
+
+if __name__ == "__main__":
+    main()
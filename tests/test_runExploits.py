@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+import itertools
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "analyses"))
+import runExploits
+
+class FakeMsfRpc(object):
+    # stand-in for msfrpcd: modules run for a given number of seconds without
+    # any output, and a console only becomes busy shortly after a write, like
+    # the real one
+    LAG = 0.05
+
+    def __init__(self, durations=None, sessions=True):
+        self.durations = durations or dict()
+        self.sessions = sessions
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        self.consoles = dict()
+        self.destroyed = []
+        self.open = set()
+        self.closed = False
+
+    def call(self, method, *args):
+        with self.lock:
+            return getattr(self, method.replace(".", "_"))(*args)
+
+    def console_create(self):
+        cid = str(next(self.ids))
+        self.consoles[cid] = {'pending' : [("banner\n", time.time())], 'write' : 0, 'module' : None}
+        return {'id' : cid}
+
+    def console_destroy(self, cid):
+        del self.consoles[cid]
+        self.destroyed.append(cid)
+        return {'result' : "success"}
+
+    def console_session_kill(self, cid):
+        self.consoles[cid]['pending'] = []
+        return {'result' : "success"}
+
+    def console_write(self, cid, data):
+        console = self.consoles[cid]
+        now = console['write'] = time.time()
+        at = now + self.LAG
+        for line in data.splitlines():
+            words = line.split()
+            output = ""
+            if words[0] == "use":
+                console['module'] = words[1]
+            elif words[0] == "set":
+                output = "%s => %s\n" % (words[1], words[2])
+            elif words[0] == "exploit":
+                at += self.durations.get(console['module'], 0)
+                if self.sessions:
+                    sid = str(next(self.ids) + 100)
+                    self.open.add(sid)
+                    output = "[*] Command shell session %s opened\n" % sid
+            elif words[0] == "sessions":
+                self.open.discard(words[2])
+            console['pending'].append((output, at))
+        return {'wrote' : len(data)}
+
+    def console_read(self, cid):
+        console = self.consoles[cid]
+        now = time.time()
+        ready = [x for x in console['pending'] if x[1] <= now]
+        console['pending'] = [x for x in console['pending'] if x[1] > now]
+        busy = bool(console['pending']) and now >= console['write'] + self.LAG
+        return {'data' : "".join([x[0] for x in ready]), 'busy' : busy,
+                'prompt' : "msf > "}
+
+    def close(self):
+        self.closed = True
+
+class MsfRpcPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.interval = runExploits.RPC_POLL_INTERVAL
+        runExploits.RPC_POLL_INTERVAL = 0.01
+
+    def tearDown(self):
+        runExploits.RPC_POLL_INTERVAL = self.interval
+
+    def module(self, eid):
+        return runExploits.METASPLOIT_EXPLOITS[eid].split()[1]
+
+    def test_slow_module(self):
+        # silent for longer than several polls, without being cut off
+        rpc = FakeMsfRpc({self.module(0) : 0.3})
+        pool = runExploits.MsfRpcPool(rpc, 1, 5)
+        result = pool.run("10.0.0.1", 0, os.devnull)
+        self.assertEqual(result['status'], "success")
+
+    def test_read(self):
+        rpc = FakeMsfRpc()
+        pool = runExploits.MsfRpcPool(rpc, 1, 5)
+        cid = pool.console()
+        self.assertEqual(pool.execute(cid, "set A b\n", time.time() + 5), "A => b\nFIRMADYNE_DONE => 0\n")
+        self.assertIsNone(pool.read(cid, time.time() - 1))
+
+    def test_only_own_sessions_killed(self):
+        rpc = FakeMsfRpc()
+        rpc.open.add("99")
+        pool = runExploits.MsfRpcPool(rpc, 1, 5)
+        result = pool.run("10.0.0.1", 0, os.devnull)
+        self.assertEqual(result['status'], "success")
+        self.assertEqual(rpc.open, set(["99"]))
+
+    def test_failed(self):
+        rpc = FakeMsfRpc(sessions=False)
+        pool = runExploits.MsfRpcPool(rpc, 1, 5)
+        self.assertEqual(pool.run("10.0.0.1", 0, os.devnull)['status'], "failed")
+        self.assertEqual(pool.consoles.qsize(), 1)
+
+    def test_timeout_replaces_console(self):
+        rpc = FakeMsfRpc({self.module(0) : 10})
+        pool = runExploits.MsfRpcPool(rpc, 1, 0.5)
+        result = pool.run("10.0.0.1", 0, os.devnull)
+        self.assertEqual(result['status'], "timeout")
+        self.assertEqual(rpc.destroyed, ["0"])
+        self.assertEqual(pool.created, [])
+        self.assertEqual(pool.consoles.qsize(), 0)
+
+        # the next module gets a new console
+        self.assertEqual(pool.run("10.0.0.1", 1, os.devnull)['status'], "success")
+        self.assertEqual(len(rpc.consoles), 1)
+
+    def test_close(self):
+        rpc = FakeMsfRpc()
+        pool = runExploits.MsfRpcPool(rpc, 2, 5)
+        futures = [pool.submit("10.0.0.%d" % i, e, os.devnull) for i in [1, 2] for e in [0, 1]]
+        self.assertEqual([x.result()['status'] for x in futures], ["success"] * 4)
+        self.assertEqual(rpc.open, set())
+        pool.close()
+        self.assertEqual(rpc.consoles, dict())
+        self.assertTrue(rpc.closed)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "analyses"))
+import webAccess
+
+class SegmentedBodyTest(unittest.TestCase):
+    # a server that sends the redirect in a later segment of the body, which
+    # is delimited by closing the connection unless a length is given
+    head = b"HTTP/1.0 200 OK\r\nContent-Type: text/html\r\n\r\n"
+
+    async def serve(self, reader, writer):
+        await reader.readuntil(b"\r\n\r\n")
+        writer.write(self.head + b"x" * 2000)
+        await writer.drain()
+        await asyncio.sleep(0.2)
+        writer.write(b"<script>window.location='/login.htm'</script>")
+        await writer.drain()
+        writer.close()
+
+    async def run_probe(self):
+        server = await asyncio.start_server(self.serve, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            prober = webAccess.Prober("127.0.0.1:%d" % port, concurrency=1, timeout=5)
+            return await prober.run(["index.htm"])
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    def test_redirect_in_later_segment(self):
+        results = asyncio.run(self.run_probe())
+        self.assertEqual(results, [(True, True, "-> Redirect")])
+
+    def test_redirect_in_later_segment_of_long_body(self):
+        # bodies longer than DRAIN_LIMIT are only read up to BODY_LIMIT
+        self.head = b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % \
+            (webAccess.DRAIN_LIMIT * 2)
+        results = asyncio.run(self.run_probe())
+        self.assertEqual(results, [(True, True, "-> Redirect")])
+
+if __name__ == "__main__":
+    unittest.main()